@@ -1,15 +1,7 @@
 #!/bin/bash -xue
 
-echo cleaning up...
-rm -f 2025_Proceedings_ISMIR.{aux,ain,log,out,toc}
-
-echo initial pdflatex...
-pdflatex 2025_Proceedings_ISMIR.tex
-
-echo perl script to generate authorindex...
-perl authorindex.pl 2025_Proceedings_ISMIR.aux
-
-echo final pdflatex...
-# running twice is safer
-pdflatex 2025_Proceedings_ISMIR.tex
-pdflatex 2025_Proceedings_ISMIR.tex
+# Compiles 2025_Proceedings_ISMIR.tex with as many pdflatex passes as needed and regenerates
+# the author index whenever it changes. Pass --clean to start from scratch, see
+# scripts/build_proceedings.py --help for the other options.
+cd "$(dirname "$0")"
+python3 scripts/build_proceedings.py 2025_Proceedings_ISMIR.tex "$@"
@@ -7,6 +7,8 @@ from pathlib import Path
 
 import pypdf
 
+from paper_metadata import load_papers, papers_by_id, dump_papers
+
 
 def main(proceedings_path, start_page, metadata, session_order_name, output_folder, output_json, final_name):
     # open proceedings
@@ -15,11 +17,7 @@ def main(proceedings_path, start_page, metadata, session_order_name, output_fold
     with open(session_order_name) as fp:
         session_order = json.load(fp)
 
-    with open(metadata) as fp:
-        paper_data = json.load(fp)
-        all_papers = {}
-        for d in paper_data:
-            all_papers[str(d["extra"]["submission_id"])] = d
+    all_papers = papers_by_id(load_papers(metadata))
 
     os.makedirs(output_folder, exist_ok=True)
 
@@ -35,8 +33,8 @@ def main(proceedings_path, start_page, metadata, session_order_name, output_fold
         current_paper_start = start_page + 2
 
         for paper_id in session["papers"]:
-            curr_paper = all_papers[str(paper_id)]
-            current_paper_length = curr_paper["extra"]["num_pages"]
+            curr_paper = all_papers[paper_id]
+            current_paper_length = curr_paper.extra.num_pages
 
             print("  Current paper being processed: " + str(paper_id))
 
@@ -57,7 +55,7 @@ def main(proceedings_path, start_page, metadata, session_order_name, output_fold
             paper_count += 1
 
             current_paper_start = current_paper_end + 1
-            curr_paper["extra"]["split_file"] = out_filename
+            curr_paper.extra.split_file = out_filename
             out_papers.append(curr_paper)
 
         # The session title page is always on the right-hand side of the book (odd page number)
@@ -69,8 +67,7 @@ def main(proceedings_path, start_page, metadata, session_order_name, output_fold
         else:
             start_page = current_paper_start
 
-    with open(output_json, "w", encoding='utf-8') as fp:
-        json.dump(out_papers, fp, indent=4, ensure_ascii=False)
+    dump_papers(out_papers, output_json)
 
     # Skip renaming the proceedings file to avoid issues
     # proceedings_path.rename(proceedings_path.parent / final_name)
@@ -1,18 +1,31 @@
 #!/usr/bin/env python3
 import pdfminer.high_level
 import pdfminer.layout
+import pdfminer.psparser
 import pdfminer.settings
-from pdfrw import PdfReader, PdfWriter
-from pdfrw.findobjs import page_per_xobj
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from difflib import HtmlDiff
+import csv
+import hashlib
+import html
+import json
+import os
 import re
 import tempfile
-import json
+import time
+
+from paper_metadata import load_papers
 
 
 pdfminer.settings.STRICT = False
 MAX_LEN = 2000
+# the pages of the papers are included as form XObjects in the split files, which pdfminer only
+# groups into lines and text boxes with all_texts
+LAPARAMS = pdfminer.layout.LAParams(all_texts=True)
+FIELDS = ('authors', 'title', 'abstract')
+# increase when first_page_text() or extract() change, to invalidate the cached texts
+EXTRACTOR_VERSION = f'2-pdfminer-{pdfminer.__version__}'
 
 
 def cleanup(text):
@@ -25,6 +38,40 @@ def cleanup(text):
     return text
 
 
+def layout_text(item):
+    '''Text of a layout item, as pdfminer's extract_text() writes it.'''
+    if isinstance(item, pdfminer.layout.LTContainer):
+        text = ''.join(layout_text(child) for child in item)
+    elif isinstance(item, pdfminer.layout.LTText):
+        text = item.get_text()
+    else:
+        text = ''
+    return text + '\n' if isinstance(item, pdfminer.layout.LTTextBox) else text
+
+
+def first_page_text(pdf_path):
+    '''Text of the first page of a split paper, read directly from the split file. Only the text of the
+       form XObjects on the page is kept, i.e. of the page of the paper without the header and page number
+       that the proceedings add around it, like the copy through a temporary file did. A page without form
+       XObjects is extracted whole.'''
+    page, = pdfminer.high_level.extract_pages(pdf_path, maxpages=1, laparams=LAPARAMS)
+    figures = [item for item in page if isinstance(item, pdfminer.layout.LTFigure)]
+    return ''.join(map(layout_text, figures)) if figures else layout_text(page)
+
+
+def first_page_text_via_tempfile(pdf_path):
+    '''The previous extraction, kept for --benchmark: the form XObjects of the first page are copied to
+       the pages of a temporary file with pdfrw, which is then parsed again.'''
+    from pdfrw import PdfReader, PdfWriter
+    from pdfrw.findobjs import page_per_xobj
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
+        first_page = list(page_per_xobj(PdfReader(pdf_path).pages[:1]))
+        writer = PdfWriter(f.name)
+        writer.addpages(first_page)
+        writer.write()
+        return pdfminer.high_level.extract_text(f.name)
+
+
 def extract(raw_text):
     authors_title_match = re.search(r'At(?:-\n)?tri(?:-\n)?bu(?:-\n)?tion:\W([^“]+),\W“([^”]+)”,?\W', raw_text)
     authors = cleanup(authors_title_match.group(1))
@@ -36,44 +83,193 @@ def extract(raw_text):
     return authors, title, abstract
 
 
-def quality_control(metadata_path, articles_dir, control_dir):
-    metadata_authors = []
-    pdf_authors = []
-    metadata_titles = []
-    pdf_titles = []
-    metadata_abstracts = []
-    pdf_abstracts = []
-    with open(metadata_path) as f:
-        papers = json.load(f)
-    for paper in papers:
-        pdf_path = Path(articles_dir) / paper['extra']['split_file']
-        with tempfile.NamedTemporaryFile(suffix='.pdf') as f:
-            first_page = list(page_per_xobj(PdfReader(pdf_path).pages[:1]))
-            writer = PdfWriter(f.name)
-            writer.addpages(first_page)
-            writer.write()
-            raw_text = pdfminer.high_level.extract_text(f.name)
-        authors, title, abstract = extract(raw_text)
-        metadata_lastnames = [n.split(' ')[-1] for n in paper['author']]
-        pdf_lastnames = [n.split(' ')[-1] for n in authors.replace(' and ', ',').split(',') if n]
-        if metadata_lastnames != pdf_lastnames:
-            metadata_authors.append(' '.join(metadata_lastnames))
-            pdf_authors.append(' '.join(pdf_lastnames))
-        if title.upper() != paper['title'].upper():
-            metadata_titles.append(paper['title'].upper())
-            pdf_titles.append(title.upper())
-        if abstract != paper['abstract']:
-            metadata_abstracts.extend(paper['abstract'].split('. '))
-            pdf_abstracts.extend(abstract.split('. '))
+def extract_paper(pdf_path, cache_dir=None):
+    '''Text of the first page of a split paper and the authors, title and abstract found in it (None if
+       they were not found), and the time it took to extract them. The result is cached by the content
+       hash of the file, and only extracted again if the file or the extractor version changed.'''
+    start = time.perf_counter()
+    cache_path = None
+    if cache_dir:
+        cache_path = Path(cache_dir) / f'{hashlib.sha256(Path(pdf_path).read_bytes()).hexdigest()}.json'
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                record = json.load(f)
+            if record['version'] == EXTRACTOR_VERSION:
+                return record, time.perf_counter() - start
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    try:
+        text = first_page_text(pdf_path)
+    except (ValueError, pdfminer.psparser.PSException):
+        # an empty PDF, or one whose first page cannot be read
+        text = ''
+    fields = try_extract(text)
+    if fields:
+        status = 'ok'
+    elif text.strip():
+        status = 'no authors, title or abstract found'
+    else:
+        status = 'no text extracted'
+    record = {'version': EXTRACTOR_VERSION, 'text': text, 'status': status}
+    record['authors'], record['title'], record['abstract'] = fields or (None, None, None)
+    if cache_path:
+        # written to a temporary file first, so that an interrupted run leaves no partial entries
+        tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    return record, time.perf_counter() - start
+
+
+def write_timing(papers, times, path, slowest=10):
+    '''Write the extraction time of every paper to a CSV file, slowest first, and print the slowest.'''
+    rows = sorted(zip(times, (paper.extra.split_file for paper in papers), (paper.title for paper in papers)), reverse=True)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['seconds', 'split_file', 'title'])
+        writer.writerows((f'{seconds:.3f}', split_file, title) for seconds, split_file, title in rows)
+    print(f'Extraction took {sum(times):.1f}s for {len(times)} papers, slowest:')
+    for seconds, split_file, title in rows[:slowest]:
+        print(f'  {seconds:7.3f}s {split_file} {title}')
+
 
+def compare(paper, record):
+    '''The lines to diff of the authors, title and abstract of a paper in the metadata and in its PDF, and
+       whether they match. Authors are compared by last name, titles regardless of case.'''
+    metadata_lastnames = [n.split(' ')[-1] for n in paper.author]
+    pdf_lastnames = [n.split(' ')[-1] for n in record['authors'].replace(' and ', ',').split(',') if n]
+    metadata_abstract = paper.abstract or ''
+    return {
+        'authors': (metadata_lastnames, pdf_lastnames, metadata_lastnames == pdf_lastnames),
+        'title': ([paper.title.upper()], [record['title'].upper()], record['title'].upper() == paper.title.upper()),
+        'abstract': (metadata_abstract.split('. '), record['abstract'].split('. '), record['abstract'] == metadata_abstract),
+    }
+
+
+def check_paper(paper, pdf_path, cache_dir, diff_dir):
+    '''Extract the fields of a paper from its PDF and compare them with the metadata, writing an HTML
+       diff of every field that differs to diff_dir. Returns its entry in the report and the time the
+       extraction took.'''
+    record, seconds = extract_paper(pdf_path, cache_dir)
+    entry = {'submission_id': paper.extra.submission_id, 'split_file': paper.extra.split_file,
+             'title': paper.title, 'status': record['status'], 'fields': {}}
+    if record['status'] != 'ok':
+        return entry, seconds
     diff = HtmlDiff(wrapcolumn=80)
+    for field, (metadata_lines, pdf_lines, match) in compare(paper, record).items():
+        entry['fields'][field] = {'match': match, 'metadata': metadata_lines, 'pdf': pdf_lines}
+        if not match:
+            name = f'{Path(paper.extra.split_file).stem}-{field}.html'
+            with open(diff_dir / name, 'w', encoding='utf-8') as f:
+                f.write(diff.make_file(metadata_lines, pdf_lines, f'{field.capitalize()} in metadata', f'{field.capitalize()} in PDF',
+                                       context=field == 'abstract', numlines=1))
+            entry['fields'][field]['diff'] = f'{diff_dir.name}/{name}'
+    return entry, seconds
+
+
+def write_index(report, path):
+    '''A table of all papers, linking to the diffs of the fields that differ.'''
+    rows = []
+    for entry in report['papers']:
+        cells = [html.escape(entry['split_file']), html.escape(entry['title'] or '')]
+        if entry['status'] != 'ok':
+            cells.append(f'<td colspan="{len(FIELDS)}" class="error">{html.escape(entry["status"])}</td>')
+        else:
+            for field in FIELDS:
+                result = entry['fields'][field]
+                cells.append('<td>ok</td>' if result['match'] else
+                             f'<td class="differs"><a href="{html.escape(result["diff"])}">differs</a></td>')
+        rows.append(f'<tr><td>{cells[0]}</td><td>{cells[1]}</td>{"".join(cells[2:])}</tr>')
+    summary = report['summary']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>PDF-metadata correspondence</title>
+<style>
+  table {{ border-collapse: collapse; }}
+  td, th {{ border: 1px solid #ccc; padding: 2px 6px; text-align: left; }}
+  .differs {{ background: #ffff77; }}
+  .error {{ background: #ffaaaa; }}
+</style>
+</head>
+<body>
+<p>{summary["papers"]} papers: {summary["authors"]} with different authors, {summary["title"]} with a different title,
+{summary["abstract"]} with a different abstract, {summary["errors"]} not parsed.</p>
+<table>
+<tr><th>File</th><th>Title</th>{"".join(f"<th>{field.capitalize()}</th>" for field in FIELDS)}</tr>
+{chr(10).join(rows)}
+</table>
+</body>
+</html>
+''')
+
+
+def quality_control(metadata_path, articles_dir, control_dir, jobs=None, cache_dir=None):
+    papers = load_papers(metadata_path)
     control_dir.mkdir(parents=True, exist_ok=True)
-    with open(control_dir / 'author-diff.html', 'w') as f:
-        f.write(diff.make_file(metadata_authors, pdf_authors, 'Authors in Metadata', 'Authors in PDFs'))
-    with open(control_dir / 'title-diff.html', 'w') as f:
-        f.write(diff.make_file(metadata_titles, pdf_titles, 'Titles in Metadata', 'Titles in PDFs'))
-    with open(control_dir / 'abstract-diff.html', 'w') as f:
-        f.write(diff.make_file(metadata_abstracts, pdf_abstracts, 'Abstracts in Metadata', 'Abstracts in PDFs', context=True, numlines=1))
+    if cache_dir is None:
+        cache_dir = control_dir / 'text-cache'
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    diff_dir = control_dir / 'papers'
+    diff_dir.mkdir(exist_ok=True)
+    # the diffs of the previous run
+    for path in diff_dir.glob('*.html'):
+        path.unlink()
+
+    # pdfminer is pure Python, so the papers are checked by a pool of processes; map returns the
+    # results in the order of the papers, which the report is written in
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pdf_paths = [Path(articles_dir) / paper.extra.split_file for paper in papers]
+        results = list(pool.map(check_paper, papers, pdf_paths, [cache_dir] * len(papers), [diff_dir] * len(papers)))
+
+    entries = [entry for entry, _ in results]
+    for entry in entries:
+        if entry['status'] != 'ok':
+            print(f'{entry["split_file"]} ({entry["title"]}): {entry["status"]}, check it by hand')
+    summary = {'papers': len(entries), 'errors': sum(entry['status'] != 'ok' for entry in entries)}
+    for field in FIELDS:
+        summary[field] = sum(not entry['fields'][field]['match'] for entry in entries if entry['status'] == 'ok')
+    report = {'summary': summary, 'papers': entries}
+    with open(control_dir / 'report.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    write_index(report, control_dir / 'index.html')
+    print(f'{summary["authors"]} papers with different authors, {summary["title"]} with a different title, '
+          f'{summary["abstract"]} with a different abstract, see {control_dir / "index.html"}')
+    write_timing(papers, [seconds for _, seconds in results], control_dir / 'extraction-times.csv')
+
+
+def try_extract(raw_text):
+    try:
+        return extract(raw_text)
+    except AttributeError:
+        return None
+
+
+def benchmark(metadata_path, articles_dir):
+    '''Time the extraction of the first page of every paper with both methods, and check that the
+       authors, title and abstract found in the text are the same.'''
+    totals = [0, 0]
+    differences = []
+    print(f'{"file":<12} {"tempfile":>9} {"direct":>9}')
+    for paper in load_papers(metadata_path):
+        pdf_path = Path(articles_dir) / paper.extra.split_file
+        times = []
+        fields = []
+        for i, method in enumerate((first_page_text_via_tempfile, first_page_text)):
+            start = time.perf_counter()
+            raw_text = method(pdf_path)
+            times.append(time.perf_counter() - start)
+            totals[i] += times[-1]
+            fields.append(try_extract(raw_text))
+        if fields[0] != fields[1]:
+            differences.append(paper.extra.split_file)
+        print(f'{paper.extra.split_file:<12} {times[0]:8.3f}s {times[1]:8.3f}s')
+    print(f'{"total":<12} {totals[0]:8.3f}s {totals[1]:8.3f}s')
+    if differences:
+        print(f'Different authors, title or abstract extracted from: {", ".join(differences)}')
 
 
 if __name__ == '__main__':
@@ -81,7 +277,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("split_metadata", help="JSON containing metadata for split PDFs")
     parser.add_argument("split_articles", help="directory containing the split PDF files")
-    parser.add_argument("-o", "--output", required=True, help="output directory to diff pages to", type=Path, default='../202x_Proceedings_ISMIR/pdf-metadata-correspondence')
+    parser.add_argument("-o", "--output", help="output directory to diff pages to", type=Path, default='../202x_Proceedings_ISMIR/pdf-metadata-correspondence')
+    parser.add_argument("-j", "--jobs", type=int, help="number of processes extracting text from the papers concurrently (default: number of CPUs)")
+    parser.add_argument("--cache", type=Path, help="directory to cache the extracted texts in (default: text-cache in the output directory)")
+    parser.add_argument("--benchmark", action="store_true", help="compare the time to extract the first pages directly and through a temporary file (requires pdfrw), instead of checking")
 
     args = parser.parse_args()
-    quality_control(args.split_metadata, args.split_articles, args.output)
+    if args.benchmark:
+        benchmark(args.split_metadata, args.split_articles)
+    else:
+        quality_control(args.split_metadata, args.split_articles, args.output, args.jobs, args.cache)
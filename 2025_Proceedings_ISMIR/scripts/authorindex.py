@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''Generate the author index (.ain file) from the \\aimention records that authorindex.sty writes to
+the .aux file, without the round trip through authorindex.pl and BibTeX.
+
+Names are split into first, von, last and junior parts following the BibTeX rules, except that the
+case of a word is decided by its first letter in Unicode, so that e.g. "Émile" is not mistaken for a
+"von" particle. Names are sorted by their unidecode transliteration, as in 3_generate_committee_tex.py.
+Only \\aimention records are supported, not the \\aicite family which needs a BibTeX database.'''
+import re
+import time
+from pathlib import Path
+
+from unidecode import unidecode
+
+
+EXPLICIT_RE = re.compile(r'^\\aiexplicit\{(.+)\}\{(.+)\}$')
+OPTIONS_RE = re.compile(r'^\\aioptions\{(.*)\}$')
+FILENAME_RE = re.compile(r'^\\aifilename\{(.+)\}$')
+INPUT_RE = re.compile(r'^\\@input\{(.+)\}$')
+PAGETYPEORDER_RE = re.compile(r'^\\pagetypeorder\{([rRaAn]+)\}$')
+TWOSTRING_RE = re.compile(r'^\\aitwostring\{(.+)\}$')
+NOCOMPRESS_RE = re.compile(r'^\\ainocompressflag$')
+
+# the defaults of authorindex.sty: \aioptions{0|{vv }{ll}{, ff}{, jj}|9999|9999|pages}
+DEFAULT_NAME_FORMAT = '{vv }{ll}{, ff}{, jj}'
+DEFAULT_PAGE_TYPE_ORDER = 'rRnAa'
+HYPHEN_RE = re.compile(r'-')
+# BibTeX puts a tie instead of a space after a first token shorter than this
+LONG_TOKEN = 3
+
+ROMAN_VALUES = {'i': 1, 'v': 5, 'x': 10, 'l': 50, 'c': 100, 'd': 500, 'm': 1000}
+# control sequences for letters, as BibTeX's purify$ keeps them
+SPECIAL_LETTERS = {'i': 'i', 'j': 'j', 'oe': 'oe', 'OE': 'OE', 'ae': 'ae', 'AE': 'AE', 'aa': 'aa', 'AA': 'AA',
+                   'o': 'o', 'O': 'O', 'l': 'l', 'L': 'L', 'ss': 'ss'}
+
+
+def _split_top_level(text, pattern):
+    '''Split text at the matches of pattern outside of braces, returning the pieces and separators.'''
+    pieces, separators = [], []
+    depth = start = pos = 0
+    while pos < len(text):
+        if text[pos] == '{':
+            depth += 1
+        elif text[pos] == '}':
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            match = pattern.match(text, pos)
+            if match and match.end() > pos:
+                pieces.append(text[start:pos])
+                separators.append(match.group())
+                start = pos = match.end()
+                continue
+        pos += 1
+    pieces.append(text[start:])
+    return pieces, separators
+
+
+def split_names(field):
+    '''The names of a BibTeX name list, which are separated by "and".'''
+    names, _ = _split_top_level(field, re.compile(r'\s+and\s+', re.IGNORECASE))
+    return [name.strip() for name in names if name.strip()]
+
+
+def _words(text):
+    '''Words of a name part with the separator following each one, '~' for explicit ties.'''
+    words, separators = _split_top_level(text.strip(), re.compile(r'[\s~]+'))
+    separators = ['~' if '~' in sep else ' ' for sep in separators]
+    return [(word, sep) for word, sep in zip(words, separators + [''])] if words != [''] else []
+
+
+def _is_lower(word):
+    '''Case of a word as BibTeX decides it, by the first letter outside of braces or of a special
+       character like {\\"o}, but for any Unicode letter. Words without such a letter count as upper case.'''
+    depth = 0
+    i = 0
+    while i < len(word):
+        char = word[i]
+        if char == '{':
+            if depth == 0 and word[i + 1:i + 2] == '\\':
+                # special character: the case of its first letter after the control sequence
+                match = re.match(r'\{\\([a-zA-Z]+|.)\s*\{?([^\W\d_])?', word[i:])
+                if match is None:
+                    return False
+                letter = match.group(1) if match.group(1) in SPECIAL_LETTERS else match.group(2)
+                return bool(letter) and letter.islower()
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif depth == 0 and char.isalpha():
+            return char.islower()
+        i += 1
+    return False
+
+
+def parse_name(name):
+    '''Split a name into its first, von, last and junior parts, each a list of (word, separator).'''
+    parts, _ = _split_top_level(name, re.compile(r','))
+    parts = [_words(part) for part in parts]
+    if len(parts) == 1:
+        # First von Last: von is everything from the first to the last lower-case word but the last word
+        words = parts[0]
+        lower = [i for i, (word, _) in enumerate(words[:-1]) if _is_lower(word)]
+        if lower:
+            first, von, last = words[:lower[0]], words[lower[0]:lower[-1] + 1], words[lower[-1] + 1:]
+        else:
+            first, von, last = words[:-1], [], words[-1:]
+        return first, von, last, []
+    # von Last, First or von Last, Jr, First
+    words = parts[0]
+    lower = [i for i, (word, _) in enumerate(words[:-1]) if _is_lower(word)]
+    von, last = (words[:lower[-1] + 1], words[lower[-1] + 1:]) if lower else ([], words)
+    jr, first = (parts[1], parts[2]) if len(parts) > 2 else ([], parts[1])
+    return first, von, last, jr
+
+
+def _text_length(text):
+    return sum(char.isalnum() for char in text)
+
+
+def _abbreviate(word):
+    pieces, _ = _split_top_level(word, HYPHEN_RE)
+    letters = []
+    for piece in pieces:
+        match = re.match(r'\{\\[^}]*\}|\{[^}]*\}|.', piece)
+        letters.append(match.group() if match else '')
+    return '.-'.join(letters)
+
+
+def format_part(words, abbreviate):
+    '''Join the words of a name part, with ties where BibTeX's format.name$ puts them: between the last
+       two words and after a short first word.'''
+    # the last two words are not tied if the last one is hyphenated, its parts are the last two tokens
+    last_hyphenated = len(_split_top_level(words[-1][0], HYPHEN_RE)[0]) > 1
+    text = ''
+    for i, (word, sep) in enumerate(words):
+        text += _abbreviate(word) if abbreviate else word
+        if i == len(words) - 1:
+            break
+        if abbreviate:
+            text += '.'
+        if sep == '~' or (i == len(words) - 2 and not last_hyphenated) or _text_length(text) < LONG_TOKEN:
+            text += '~'
+        else:
+            text += ' '
+    return text
+
+
+PART_RE = re.compile(r'\{([^a-zA-Z{}]*)(ff|vv|ll|jj|f|v|l|j)([^{}]*)\}')
+
+
+def format_name(name, name_format=DEFAULT_NAME_FORMAT):
+    '''Format a name like BibTeX's format.name$, e.g. "von Last, First, Jr" for the default format.'''
+    first, von, last, jr = parse_name(name)
+    parts = {'f': first, 'v': von, 'l': last, 'j': jr}
+    output = ''
+    pos = 0
+    for match in PART_RE.finditer(name_format):
+        output += name_format[pos:match.start()]
+        pos = match.end()
+        pre, letters, post = match.groups()
+        words = parts[letters[0]]
+        if not words:
+            continue
+        text = format_part(words, abbreviate=len(letters) == 1)
+        if post.endswith('~') and _text_length(text) >= LONG_TOKEN:
+            # a tie at the end of a part is discretionary
+            post = post[:-1] + ' '
+        output += pre + text + post
+    return output + name_format[pos:]
+
+
+def purify(text):
+    '''Like BibTeX's purify$: only letters, digits and spaces, with ties and hyphens as spaces.'''
+    text = re.sub(r'\\([a-zA-Z]+|.)', lambda match: SPECIAL_LETTERS.get(match.group(1), ''), text)
+    text = text.replace('~', ' ').replace('-', ' ')
+    return ''.join(char for char in text if char.isalnum() or char.isspace())
+
+
+def sort_key(name):
+    return unidecode(purify(name)).upper()
+
+
+def _roman_value(numeral):
+    total, previous = 0, 1
+    for value in (ROMAN_VALUES[char] for char in reversed(numeral.lower())):
+        total += -value if value < previous else value
+        previous = value
+    return total
+
+
+def page_order(page, type_order=DEFAULT_PAGE_TYPE_ORDER):
+    '''Sort key of a page number consisting of arabic, roman and alphabetic components, where the
+       page types are ordered according to type_order.'''
+    types = {kind: str(i) for i, kind in enumerate(type_order)}
+    rules = [('n', r'\d+', lambda m: '%06d' % int(m)),
+             ('R', r'\\uppercase\s*\{([ivxlcdm]+)\}', lambda m: '%04d' % _roman_value(m)),
+             ('R', r'[IVXLCDM]+', lambda m: '%04d' % _roman_value(m)),
+             ('A', r'[A-Z]', lambda m: '%02d' % (ord(m.lower()) - ord('a'))),
+             ('r', r'[ivxlcdm]+', lambda m: '%04d' % _roman_value(m)),
+             ('a', r'[a-z]', lambda m: '%02d' % (ord(m) - ord('a')))]
+    key = ''
+    while page:
+        page = re.sub(r'^[^\\A-Za-z0-9]*', '', page)
+        for kind, pattern, value in rules:
+            match = re.match(pattern, page)
+            if kind in types and match:
+                key += types[kind] + value(match.group(match.lastindex or 0))
+                page = page[match.end():]
+                break
+        else:
+            page = page[1:]
+    return key
+
+
+def _follows(previous, key):
+    # authorindex.pl increments the digit string of the previous page's sort key
+    return previous.isdigit() and str(int(previous) + 1).zfill(len(previous)) == key
+
+
+class AuthorIndex:
+    '''Pages on which each author is mentioned, collected from the records of one or more .aux files.'''
+
+    def __init__(self):
+        self.name_format = DEFAULT_NAME_FORMAT
+        self.page_type_order = DEFAULT_PAGE_TYPE_ORDER
+        self.two_pages = ''
+        self.compress = True
+        self.filename = None
+        # formatted name -> {page: whether the author is the first of the mentioned names}
+        self.pages = {}
+
+    def add_record(self, line):
+        '''Add one line of an .aux file, returning the name of an .aux file it includes, if any.'''
+        line = line.rstrip('\n')
+        if match := EXPLICIT_RE.match(line):
+            field, page = match.groups()
+            for i, name in enumerate(split_names(field)):
+                if name == 'others':
+                    # "and others", i.e. et al.
+                    continue
+                # brackets would end the \item[] of the index entry
+                formatted = re.sub(r'\\IeC |[\[\]]', '', format_name(name, self.name_format))
+                pages = self.pages.setdefault(formatted, {})
+                pages[page] = pages.get(page, False) or i == 0
+        elif match := OPTIONS_RE.match(line):
+            options = match.group(1).split('|')
+            if len(options) > 1 and options[1]:
+                self.name_format = options[1].split(';')[0].split(':')[0]
+        elif match := FILENAME_RE.match(line):
+            self.filename = match.group(1)
+        elif match := PAGETYPEORDER_RE.match(line):
+            self.page_type_order = match.group(1)
+        elif match := TWOSTRING_RE.match(line):
+            self.two_pages = match.group(1)
+        elif NOCOMPRESS_RE.match(line):
+            self.compress = False
+        elif match := INPUT_RE.match(line):
+            return match.group(1)
+        return None
+
+    def format_pages(self, pages):
+        '''Sorted list of pages, with runs of consecutive pages compressed to ranges.'''
+        keys = {page: page_order(page, self.page_type_order) for page in pages}
+        result = ''
+        pending = ''
+        previous = None
+        for page in sorted(pages, key=keys.get):
+            representation = f'\\aifirstpage{{{page}}}' if pages[page] else page
+            if previous is None:
+                result = representation
+            elif self.compress and _follows(keys[previous], keys[page]):
+                pending = f'--{representation}' if pending else (self.two_pages or f', {representation}')
+            else:
+                result += pending + f', {representation}'
+                pending = ''
+            previous = page
+        return result + pending
+
+    def entries(self):
+        '''(name, formatted pages) of all authors in the order of the index.'''
+        for name in sorted(self.pages, key=lambda name: (sort_key(name), name)):
+            yield name, self.format_pages(self.pages[name])
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write('\\begin{theauthorindex}\n')
+            previous_initial = ''
+            for name, pages in self.entries():
+                initial = sort_key(name)[:1]
+                if initial != previous_initial:
+                    if previous_initial:
+                        fp.write('\\indexspace\n')
+                    previous_initial = initial
+                fp.write(f'\\item[{name}] \\aipages{{{pages}}}\n')
+            fp.write('\\end{theauthorindex}\n')
+
+
+def build_index(lines):
+    '''The author index of the given .aux lines, e.g. those already read by a build driver.'''
+    index = AuthorIndex()
+    for line in lines:
+        index.add_record(line)
+    return index
+
+
+def read_aux(aux_path, follow_includes=True):
+    '''Read an .aux file and the .aux files of \\include-d files, each in a single streaming pass.'''
+    aux_path = Path(aux_path)
+    index = AuthorIndex()
+    queue = [aux_path]
+    while queue:
+        with open(queue.pop(0), encoding='utf-8', errors='replace') as fp:
+            for line in fp:
+                included = index.add_record(line)
+                if included and follow_includes:
+                    queue.append(aux_path.parent / included)
+    return index
+
+
+def generate(aux_path, follow_includes=True):
+    '''Write the author index of an .aux file to the .ain file named in it, returning its path.'''
+    index = read_aux(aux_path, follow_includes)
+    if index.filename is None:
+        raise ValueError(f'{aux_path} has no \\aifilename record, is the authorindex package used?')
+    ain_path = Path(aux_path).parent / index.filename
+    index.write(ain_path)
+    return ain_path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate the author index (.ain) from the \\aimention records of a LaTeX .aux file")
+    parser.add_argument("aux", help=".aux file of the proceedings", type=Path)
+    parser.add_argument("-r", "--no_includes", action="store_true", help="do not read the .aux files of \\include-d files")
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    ain_path = generate(args.aux, not args.no_includes)
+    print(f'Author index written to {ain_path} in {time.perf_counter() - start:.2f}s')
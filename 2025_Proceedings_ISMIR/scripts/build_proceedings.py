@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import pypdf
+
+import authorindex
+
+
+# auxiliary files that pdflatex reads back in on the next pass
+AUX_EXTENSIONS = ('.aux', '.toc', '.out', '.ain')
+CLEAN_EXTENSIONS = ('.aux', '.ain', '.log', '.out', '.toc')
+
+# written to the .aux file by \includepaper when compiled with \placeholderpapers, see ismirproc.cls
+PLACEHOLDER_RE = re.compile(r'\\placeholderpaper\{([^}]*)\}\{(\d+)\}\{(\d+)\}\{(\d+)\}')
+Placeholder = namedtuple('Placeholder', ['pdf', 'page', 'index', 'pages'])
+
+
+def file_hashes(tex_path):
+    hashes = {}
+    for ext in AUX_EXTENSIONS:
+        try:
+            hashes[ext] = hashlib.sha256(tex_path.with_suffix(ext).read_bytes()).hexdigest()
+        except FileNotFoundError:
+            hashes[ext] = None
+    return hashes
+
+
+def author_index_entries(tex_path):
+    # the \aiexplicit, \aioptions, ... records written by \aimention are all the author index is built from
+    try:
+        with open(tex_path.with_suffix('.aux'), encoding='utf-8', errors='replace') as fp:
+            return [line for line in fp if line.startswith('\\ai')]
+    except FileNotFoundError:
+        return []
+
+
+def run_measured(cmd, cwd, verbose=False):
+    '''Run a command, returning its exit code, wall time in seconds and peak memory in bytes. The peak
+       memory is None where os.wait4 is not available (Windows).'''
+    start = time.perf_counter()
+    stdout = None if verbose else subprocess.DEVNULL
+    if not hasattr(os, 'wait4'):
+        returncode = subprocess.run(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=stdout).returncode
+        return returncode, time.perf_counter() - start, None
+    proc = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=stdout)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    peak = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return proc.returncode, elapsed, peak
+
+
+def report(step, elapsed, peak):
+    memory = f', peak memory {peak / 2**20:.0f} MB' if peak is not None else ''
+    print(f'{step}: {elapsed:.1f}s{memory}', flush=True)
+
+
+def run_pdflatex(tex_path, verbose=False, cwd=None, placeholders=False):
+    '''Compile tex_path from cwd (default: its own directory), writing all output next to it.'''
+    cwd = cwd or tex_path.parent
+    source = os.path.relpath(tex_path, cwd)
+    cmd = ['pdflatex', '-interaction=nonstopmode', '-halt-on-error',
+           f'-output-directory={os.path.relpath(tex_path.parent, cwd)}']
+    if placeholders:
+        cmd += [f'-jobname={tex_path.stem}', f'\\def\\placeholderpapers{{}}\\input{{{source}}}']
+    else:
+        cmd.append(source)
+    returncode, elapsed, peak = run_measured(cmd, cwd, verbose)
+    if returncode != 0:
+        log = tex_path.with_suffix('.log')
+        tail = log.read_text(errors='replace').splitlines()[-20:] if log.exists() else []
+        raise RuntimeError(f'pdflatex failed with exit code {returncode}, see {log}:\n' + '\n'.join(tail))
+    return elapsed, peak
+
+
+def write_authorindex(tex_path, entries):
+    '''Generate the author index in-process from the records already read from the .aux file.'''
+    start = time.perf_counter()
+    index = authorindex.build_index(entries)
+    index.write(tex_path.with_name(index.filename or tex_path.with_suffix('.ain').name))
+    return time.perf_counter() - start
+
+
+def build(tex_path, clean=False, max_passes=5, verbose=False, placeholders=False):
+    '''Run pdflatex until the auxiliary files it reads back in no longer change, regenerating the
+       author index whenever its records in the .aux file change. Returns the number of passes.
+       With placeholders, the papers are replaced by empty pages, see build_sessions.'''
+    tex_path = Path(tex_path).resolve()
+    if clean:
+        for ext in CLEAN_EXTENSIONS:
+            tex_path.with_suffix(ext).unlink(missing_ok=True)
+
+    total = time.perf_counter()
+    # an existing author index was built from the current .aux by the previous build
+    indexed_entries = author_index_entries(tex_path) if tex_path.with_suffix('.ain').exists() else None
+    for n in range(1, max_passes + 1):
+        before = file_hashes(tex_path)
+        report(f'pdflatex pass {n}', *run_pdflatex(tex_path, verbose, placeholders=placeholders))
+        entries = author_index_entries(tex_path)
+        if entries and entries != indexed_entries:
+            print(f'author index: {write_authorindex(tex_path, entries):.1f}s', flush=True)
+            indexed_entries = entries
+        if file_hashes(tex_path) == before:
+            print(f'Converged after {n} pass{"es" if n > 1 else ""}, {time.perf_counter() - total:.1f}s in total')
+            return n
+    print(f'WARNING: auxiliary files still changing after {max_passes} passes, '
+          'check the output for unresolved references')
+    return max_passes
+
+
+def placeholder_sessions(tex_path):
+    '''The placeholder pages recorded in the .aux file, grouped into runs of consecutive pages. Sessions
+       are separated by their title page, so every run holds the papers of one session.'''
+    with open(tex_path.with_suffix('.aux'), encoding='utf-8', errors='replace') as fp:
+        papers = [Placeholder(pdf, *map(int, numbers)) for pdf, *numbers in PLACEHOLDER_RE.findall(fp.read())]
+    sessions = []
+    for paper in papers:
+        if sessions and sessions[-1][-1].index + sessions[-1][-1].pages == paper.index:
+            sessions[-1].append(paper)
+        else:
+            sessions.append([paper])
+    return sessions
+
+
+def session_document(preamble, papers):
+    # titles and authors are left out, the table of contents and author index come from the main document
+    lines = [preamble + '\\begin{document}',
+             '\\renewcommand{\\addtoauthorindex}[1]{}',
+             f'\\setcounter{{page}}{{{papers[0].page}}}']
+    lines += [f'\\includepaper{{}}{{}}{{{paper.pdf}}}' for paper in papers]
+    lines.append('\\end{document}\n')
+    return '\n'.join(lines)
+
+
+def session_hash(document, tex_dir, papers):
+    digest = hashlib.sha256(document.encode())
+    for path in sorted(tex_dir.glob('*.cls')) + [tex_dir / paper.pdf for paper in papers]:
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def stitch(pdf_path, sessions, session_dir):
+    '''Fill the placeholder pages of the main document with the pages of the compiled sessions.'''
+    start = time.perf_counter()
+    writer = pypdf.PdfWriter(clone_from=pdf_path)
+    for n, papers in enumerate(sessions, 1):
+        reader = pypdf.PdfReader(session_dir / f'session{n:02d}.pdf')
+        expected = sum(paper.pages for paper in papers)
+        if len(reader.pages) != expected:
+            raise RuntimeError(f'session {n} has {len(reader.pages)} pages instead of {expected}')
+        for i, page in enumerate(reader.pages, papers[0].index):
+            writer.pages[i].merge_page(page)
+    tmp_path = pdf_path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as fp:
+        writer.write(fp)
+    os.replace(tmp_path, pdf_path)
+    print(f'stitched {len(sessions)} sessions into {pdf_path.name}: {time.perf_counter() - start:.1f}s')
+
+
+def check_paperpages(tex_path):
+    '''Placeholders need the number of pages of every paper, which papers.tex declares with \\paperpages.'''
+    if not any('\\paperpages{' in path.read_text(encoding='utf-8', errors='replace')
+               for path in tex_path.parent.glob('*.tex')):
+        raise RuntimeError(f'No \\paperpages found in the .tex files of {tex_path.parent}, '
+                           'regenerate papers.tex with 2_generate_paper_tex.py to use --sessions')
+
+
+def compare_pages(reference_path, pdf_path):
+    '''Pages of pdf_path that differ from reference_path in size or text, 1-based; a differing number of
+       pages is reported as the pages beyond the shorter one.'''
+    reference, pdf = pypdf.PdfReader(reference_path), pypdf.PdfReader(pdf_path)
+    differences = [n for n, (a, b) in enumerate(zip(reference.pages, pdf.pages), 1)
+                   if list(a.mediabox) != list(b.mediabox) or a.extract_text() != b.extract_text()]
+    shorter, longer = sorted((len(reference.pages), len(pdf.pages)))
+    return differences + list(range(shorter + 1, longer + 1))
+
+
+def build_sessions(tex_path, clean=False, max_passes=5, verbose=False, jobs=None, verify=False):
+    '''Build the main document with empty placeholder pages for the papers, which is quick, then compile
+       each session as its own document starting at the page number of its placeholders, in parallel,
+       and stitch them into the placeholder pages. Sessions whose inputs did not change since the last
+       build are not recompiled. With verify, the document is first built the normal way, and the
+       stitched document must have the same pages.'''
+    tex_path = Path(tex_path).resolve()
+    check_paperpages(tex_path)
+    if verify:
+        build(tex_path, clean, max_passes, verbose)
+        reference_path = tex_path.with_name(f'{tex_path.stem}-reference.pdf')
+        shutil.copyfile(tex_path.with_suffix('.pdf'), reference_path)
+    build(tex_path, clean, max_passes, verbose, placeholders=True)
+    sessions = placeholder_sessions(tex_path)
+    if not sessions:
+        raise RuntimeError('No placeholder pages found, regenerate papers.tex with 2_generate_paper_tex.py')
+
+    session_dir = tex_path.with_name(f'{tex_path.stem}-sessions')
+    session_dir.mkdir(exist_ok=True)
+    manifest_path = session_dir / 'manifest.json'
+    manifest = {}
+    if manifest_path.exists() and not clean:
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+
+    preamble = tex_path.read_text(encoding='utf-8').split('\\begin{document}', 1)[0]
+    changed = {}
+    for n, papers in enumerate(sessions, 1):
+        session_tex = session_dir / f'session{n:02d}.tex'
+        document = session_document(preamble, papers)
+        digest = session_hash(document, tex_path.parent, papers)
+        if manifest.get(session_tex.name) != digest or not session_tex.with_suffix('.pdf').exists():
+            session_tex.write_text(document, encoding='utf-8')
+            changed[session_tex] = digest
+    print(f'{len(changed)} of {len(sessions)} sessions changed')
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {pool.submit(run_pdflatex, session_tex, verbose, tex_path.parent): session_tex
+                   for session_tex in changed}
+        for future in as_completed(futures):
+            session_tex = futures[future]
+            report(session_tex.stem, *future.result())
+            manifest[session_tex.name] = changed[session_tex]
+            with open(manifest_path, 'w') as fp:
+                json.dump(manifest, fp, indent=4)
+
+    stitch(tex_path.with_suffix('.pdf'), sessions, session_dir)
+    if verify:
+        differences = compare_pages(reference_path, tex_path.with_suffix('.pdf'))
+        if differences:
+            raise RuntimeError(f'{len(differences)} pages differ from the normal build {reference_path.name}: '
+                               + ', '.join(map(str, differences[:20])))
+        print(f'All pages are the same as in the normal build {reference_path.name}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile the proceedings with as many pdflatex passes as needed, including the author index")
+    parser.add_argument("tex", help="main tex file of the proceedings", type=Path)
+    parser.add_argument("--clean", action="store_true", help="remove auxiliary files from previous builds first")
+    parser.add_argument("--max_passes", type=int, default=5, help="maximum number of pdflatex passes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of pdflatex")
+    parser.add_argument("--sessions", action="store_true", help="compile the sessions as separate documents in parallel and stitch them together")
+    parser.add_argument("-j", "--jobs", type=int, help="number of sessions to compile concurrently (default: number of CPUs)")
+    parser.add_argument("--verify", action="store_true", help="with --sessions, also build the document the normal way first and check that the stitched document has the same pages")
+
+    args = parser.parse_args()
+    try:
+        if args.sessions:
+            build_sessions(args.tex, args.clean, args.max_passes, args.verbose, args.jobs, args.verify)
+        else:
+            build(args.tex, args.clean, args.max_passes, args.verbose)
+    except RuntimeError as e:
+        sys.exit(str(e))
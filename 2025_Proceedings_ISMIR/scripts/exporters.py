@@ -0,0 +1,205 @@
+'''Output formats of the final metadata. Every format is an Emitter that writes its file while the papers
+are visited once, in the order of the proceedings; adding a format means adding an Emitter to EMITTERS.'''
+import json
+import os
+import re
+import string
+import textwrap
+from xml.sax.saxutils import XMLGenerator
+
+import jinja2
+from unidecode import unidecode
+
+import authorindex
+
+
+DEFAULT_BOOKTITLE = 'Proceedings of the International Society for Music Information Retrieval Conference'
+# the conference as DBLP names it in its records
+DBLP_BOOKTITLE = 'ISMIR'
+
+
+class Emitter:
+    '''Writes one output format to filename in the output directory: begin() is called before the first
+       paper, paper() for every paper with the name of its session, and end() after the last paper.'''
+    filename = None
+
+    def __init__(self, output_dir, booktitle=DEFAULT_BOOKTITLE):
+        self.path = os.path.join(output_dir, self.filename)
+        self.booktitle = booktitle
+        self.fp = None
+
+    def begin(self):
+        self.fp = open(self.path, 'w', encoding='utf-8')
+
+    def paper(self, paper, session):
+        raise NotImplementedError
+
+    def end(self):
+        self.fp.close()
+
+
+class JsonArrayEmitter(Emitter):
+    '''A JSON array of one record per paper, formatted like json.dump(records, indent=4).'''
+
+    def begin(self):
+        super().begin()
+        self.count = 0
+
+    def record(self, paper, session):
+        raise NotImplementedError
+
+    def paper(self, paper, session):
+        text = json.dumps(self.record(paper, session), indent=4, ensure_ascii=False)
+        self.fp.write(('[\n' if not self.count else ',\n') + textwrap.indent(text, '    '))
+        self.count += 1
+
+    def end(self):
+        self.fp.write('\n]' if self.count else '[]')
+        super().end()
+
+
+class PublicJsonEmitter(JsonArrayEmitter):
+    '''The archive JSON for the proceedings archiver.'''
+    filename = '202x.json'
+
+    def record(self, paper, session):
+        return paper.to_public_json()
+
+
+class InternalJsonEmitter(JsonArrayEmitter):
+    '''The archive JSON with the internal metadata, for the organizers.'''
+    filename = '202x_internal.json'
+
+    def record(self, paper, session):
+        return paper.to_internal_json()
+
+
+class OverviewCsvEmitter(Emitter):
+    '''The paper list for the MiniConf site, one line per paper rendered from templates/overview.csv.'''
+    filename = 'overview.csv'
+
+    def begin(self):
+        super().begin()
+        path = os.path.dirname(os.path.abspath(__file__))
+        template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(path, 'templates')))
+        self.template = template_env.get_template('overview.csv')
+
+    def paper(self, paper, session):
+        self.fp.write(self.template.render(publication=paper) + '\n')
+
+
+def name_parts(name):
+    '''Given names, particle and family name of an author, split like BibTeX does.'''
+    first, von, last, jr = authorindex.parse_name(name)
+    return tuple(' '.join(word for word, _ in part) for part in (first, von, last, jr))
+
+
+BIBTEX_SPECIAL_RE = re.compile(r'([#$%&_])')
+
+
+def bibtex_escape(text):
+    return BIBTEX_SPECIAL_RE.sub(r'\\\1', text)
+
+
+class BibtexEmitter(Emitter):
+    '''A BibTeX @inproceedings entry per paper, with keys like smith2023title.'''
+    filename = '202x.bib'
+
+    def begin(self):
+        super().begin()
+        self.keys = set()
+
+    def key(self, paper):
+        family = name_parts(paper.author[0])[2] if paper.author else 'anonymous'
+        title_words = [word for word in re.findall(r'\w+', unidecode(paper.title or '').lower()) if len(word) > 3]
+        key = re.sub(r'\W', '', unidecode(family).lower()) + (paper.year or '') + (title_words[0] if title_words else '')
+        # a, b, ... for papers that would get the same key
+        key = next(key + suffix for suffix in ('', *string.ascii_lowercase) if key + suffix not in self.keys)
+        self.keys.add(key)
+        return key
+
+    def paper(self, paper, session):
+        fields = [('author', ' and '.join(paper.author)),
+                  ('title', f'{{{paper.title}}}'),
+                  ('booktitle', self.booktitle),
+                  ('year', paper.year),
+                  ('pages', paper.pages.replace('-', '--') if paper.pages else None),
+                  ('doi', paper.doi),
+                  ('url', paper.url or paper.ee)]
+        lines = [f'  {name} = {{{bibtex_escape(value) if name not in ("doi", "url") else value}}}'
+                 for name, value in fields if value]
+        self.fp.write(f'@inproceedings{{{self.key(paper)},\n' + ',\n'.join(lines) + '\n}\n\n')
+
+
+class CslJsonEmitter(JsonArrayEmitter):
+    '''CSL-JSON, as read by reference managers and citeproc.'''
+    filename = '202x_csl.json'
+
+    def record(self, paper, session):
+        authors = []
+        for name in paper.author:
+            given, particle, family, suffix = name_parts(name)
+            author = {'family': family, 'given': given}
+            if particle:
+                author['non-dropping-particle'] = particle
+            if suffix:
+                author['suffix'] = suffix
+            authors.append(author)
+        record = {'id': str(paper.extra.submission_id), 'type': 'paper-conference', 'title': paper.title,
+                  'author': authors, 'container-title': self.booktitle}
+        if paper.year:
+            record['issued'] = {'date-parts': [[int(paper.year)]]}
+        optional = {'page': paper.pages, 'DOI': paper.doi, 'URL': paper.url or paper.ee, 'abstract': paper.abstract}
+        record.update((key, value) for key, value in optional.items() if value)
+        return record
+
+
+class DblpXmlEmitter(Emitter):
+    '''The papers as DBLP inproceedings records.'''
+    filename = '202x_dblp.xml'
+
+    def begin(self):
+        super().begin()
+        self.xml = XMLGenerator(self.fp, encoding='utf-8', short_empty_elements=True)
+        self.xml.startDocument()
+        self.xml.startElement('dblp', {})
+
+    def element(self, name, text, indent='\n    '):
+        self.xml.ignorableWhitespace(indent)
+        self.xml.startElement(name, {})
+        self.xml.characters(text)
+        self.xml.endElement(name)
+
+    def paper(self, paper, session):
+        self.xml.ignorableWhitespace('\n  ')
+        self.xml.startElement('inproceedings', {'key': paper.dblp_key} if paper.dblp_key else {})
+        for name in paper.author:
+            self.element('author', name)
+        self.element('title', paper.title)
+        if paper.pages:
+            self.element('pages', paper.pages)
+        self.element('year', paper.year)
+        self.element('booktitle', DBLP_BOOKTITLE)
+        if paper.doi:
+            self.element('ee', f'https://doi.org/{paper.doi}')
+        if paper.ee:
+            self.element('ee', paper.ee)
+        self.xml.ignorableWhitespace('\n  ')
+        self.xml.endElement('inproceedings')
+
+    def end(self):
+        self.xml.ignorableWhitespace('\n')
+        self.xml.endElement('dblp')
+        self.xml.endDocument()
+        self.fp.write('\n')
+        super().end()
+
+
+EMITTERS = {
+    'json': PublicJsonEmitter,
+    'internal_json': InternalJsonEmitter,
+    'overview': OverviewCsvEmitter,
+    'bibtex': BibtexEmitter,
+    'csl': CslJsonEmitter,
+    'dblp': DblpXmlEmitter,
+}
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import pypdf
+
+from page_count import find_pdfs, get_number_pages
+
+
+QPDF_ARGS = ['--linearize']
+
+
+def is_linearized(pdf_path):
+    # qpdf --is-linearized exits with 0 for linearized files and 2 otherwise
+    return subprocess.run(['qpdf', '--is-linearized', str(pdf_path)],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def linearize(pdf_path, force=False):
+    '''Linearize a PDF in place with qpdf, so that viewers can show the first page before the whole
+       file is downloaded. The result must open and have the same number of pages as the original,
+       otherwise the original is kept. Returns a status message, or raises RuntimeError.'''
+    if not force and is_linearized(pdf_path):
+        return 'already linearized, skipped'
+    start = time.perf_counter()
+    num_pages = get_number_pages(pdf_path)
+    tmp_path = pdf_path.with_name(pdf_path.name + '.linearized')
+    try:
+        # exit code 3 means qpdf succeeded with warnings, e.g. about repaired damage
+        result = subprocess.run(['qpdf', *QPDF_ARGS, str(pdf_path), str(tmp_path)], capture_output=True, text=True)
+        if result.returncode not in (0, 3):
+            raise RuntimeError(f'qpdf exit code {result.returncode}: {result.stderr.strip()}')
+        result = subprocess.run(['qpdf', '--check-linearization', str(tmp_path)], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'linearization check failed: {(result.stderr or result.stdout).strip()}')
+        new_num_pages = len(pypdf.PdfReader(tmp_path).pages)
+        if new_num_pages != num_pages:
+            raise RuntimeError(f'{new_num_pages} pages after linearization instead of {num_pages}')
+        before, after = pdf_path.stat().st_size, tmp_path.stat().st_size
+        os.replace(tmp_path, pdf_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return f'ok, {num_pages} pages, {before} -> {after} bytes, {time.perf_counter() - start:.1f}s'
+
+
+def linearize_all(paths, jobs=None, force=False):
+    pdfs = find_pdfs(paths)
+    failures = []
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {pool.submit(linearize, pdf, force): pdf for pdf in pdfs}
+        for future in as_completed(futures):
+            pdf = futures[future]
+            try:
+                status = future.result()
+            except (RuntimeError, pypdf.errors.PyPdfError) as e:
+                failures.append((pdf, e))
+                status = f'FAILED ({e})'
+            print(f'{pdf}: {status}', flush=True)
+    if failures:
+        print(f'\n{len(failures)} of {len(pdfs)} files could not be linearized and were left unchanged:')
+        for pdf, error in sorted(failures):
+            print(f'  {pdf}: {error}')
+    return failures
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Linearize (fast web view) the published PDFs in place with qpdf, in parallel")
+    parser.add_argument("paths", nargs='+', type=Path, help="PDF files, or directories to search for PDFs (e.g. the split articles and the final proceedings)")
+    parser.add_argument("-j", "--jobs", type=int, help="number of files to linearize concurrently (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="linearize again files that already are")
+
+    args = parser.parse_args()
+    if shutil.which('qpdf') is None:
+        sys.exit('qpdf not found, install it from https://qpdf.sourceforge.io or your package manager')
+    if linearize_all(args.paths, args.jobs, args.force):
+        sys.exit(1)
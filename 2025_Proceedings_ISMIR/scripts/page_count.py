@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pypdf
+
+
+TAIL_SIZE = 4096
+CHUNK_SIZE = 65536
+
+STARTXREF_RE = re.compile(rb'startxref\s+(\d+)')
+OBJ_HEADER_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+REF_RE = r'/{}\s+(\d+)\s+(\d+)\s+R'
+INT_RE = r'/{}\s+(\d+)\b(?!\s+\d+\s+R)'
+
+
+def _ref(key, text):
+    match = re.search(REF_RE.format(key).encode(), text)
+    return int(match.group(1)) if match else None
+
+
+def _int(key, text):
+    match = re.search(INT_RE.format(key).encode(), text)
+    return int(match.group(1)) if match else None
+
+
+def _array(key, text):
+    match = re.search(r'/{}\s*\[([^\]]*)\]'.format(key).encode(), text)
+    return [int(i) for i in match.group(1).split()] if match else None
+
+
+def _read_from(fp, offset, marker):
+    '''Read from offset until marker has been seen, growing the read in chunks.'''
+    fp.seek(offset)
+    data = fp.read(CHUNK_SIZE)
+    while marker not in data:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError(f'{marker!r} not found after offset {offset}')
+        data += chunk
+    return data
+
+
+def _stream_dict(data):
+    '''Split an object read from its header into the dictionary text and the offset of its stream data.'''
+    stream = re.search(rb'>>\s*stream(\r\n|\n)', data)
+    if stream is None:
+        raise ValueError('object has no stream')
+    return data[:stream.start() + 2], stream.end()
+
+
+def _decode(fp, offset, data):
+    obj_dict, start = _stream_dict(data)
+    length = _int('Length', obj_dict)
+    if length is None:
+        raise ValueError('stream length is missing or indirect')
+    fp.seek(offset + start)
+    raw = fp.read(length)
+    filters = re.search(rb'/Filter\s*(?:\[([^\]]*)\]|(/\w+))', obj_dict)
+    if filters:
+        filters = (filters.group(1) or filters.group(2)).split()
+        if filters != [b'/FlateDecode']:
+            raise ValueError(f'unsupported stream filters {filters}')
+        raw = zlib.decompress(raw)
+    predictor = _int('Predictor', obj_dict) or 1
+    if predictor >= 10:
+        raw = _undo_png_predictor(raw, _int('Columns', obj_dict) or 1)
+    elif predictor != 1:
+        raise ValueError(f'unsupported predictor {predictor}')
+    return obj_dict, raw
+
+
+def _undo_png_predictor(data, columns):
+    rows = []
+    previous = bytearray(columns)
+    for i in range(0, len(data), columns + 1):
+        kind, row = data[i], bytearray(data[i + 1:i + 1 + columns])
+        if kind == 2:
+            row = bytearray((a + b) & 0xff for a, b in zip(row, previous))
+        elif kind != 0:
+            raise ValueError(f'unsupported PNG predictor type {kind}')
+        rows.append(bytes(row))
+        previous = row
+    return b''.join(rows)
+
+
+def _parse_xref_table(data):
+    # data starts with 'xref', entries are triples of offset, generation and n/f flag
+    table, trailer = data[4:].split(b'trailer', 1)
+    trailer = trailer.split(b'startxref', 1)[0]
+    tokens = table.split()
+    entries = {}
+    i = 0
+    while i < len(tokens):
+        start, count = int(tokens[i]), int(tokens[i + 1])
+        i += 2
+        for num in range(start, start + count):
+            offset, flag = int(tokens[i]), tokens[i + 2]
+            entries[num] = ('offset', offset) if flag == b'n' else None
+            i += 3
+    return entries, trailer
+
+
+def _parse_xref_stream(fp, offset, data):
+    obj_dict, raw = _decode(fp, offset, data)
+    widths = _array('W', obj_dict)
+    index = _array('Index', obj_dict) or [0, _int('Size', obj_dict)]
+    if widths is None or len(widths) != 3 or None in index:
+        raise ValueError('malformed xref stream dictionary')
+    entries = {}
+    pos = 0
+    for start, count in zip(index[::2], index[1::2]):
+        for num in range(start, start + count):
+            fields = []
+            for width in widths:
+                fields.append(int.from_bytes(raw[pos:pos + width], 'big'))
+                pos += width
+            kind = fields[0] if widths[0] else 1
+            if kind == 1:
+                entries[num] = ('offset', fields[1])
+            elif kind == 2:
+                entries[num] = ('compressed', fields[1], fields[2])
+            else:
+                entries[num] = None
+    if pos > len(raw):
+        raise ValueError('xref stream is shorter than its index')
+    return entries, obj_dict
+
+
+def _read_xref(fp):
+    '''Follow the chain of cross-reference sections from the last startxref, newest entries first.'''
+    fp.seek(0, os.SEEK_END)
+    fp.seek(max(0, fp.tell() - TAIL_SIZE))
+    startxrefs = STARTXREF_RE.findall(fp.read())
+    if not startxrefs:
+        raise ValueError('no startxref found')
+    offset = int(startxrefs[-1])
+    entries = {}
+    root = None
+    seen = set()
+    while offset is not None:
+        if offset in seen:
+            raise ValueError('loop in xref chain')
+        seen.add(offset)
+        fp.seek(offset)
+        if fp.read(4) == b'xref':
+            section, trailer = _parse_xref_table(_read_from(fp, offset, b'startxref'))
+        else:
+            section, trailer = _parse_xref_stream(fp, offset, _read_from(fp, offset, b'endobj'))
+        for num, location in section.items():
+            entries.setdefault(num, location)
+        root = root or _ref('Root', trailer)
+        offset = _int('Prev', trailer)
+    if root is None:
+        raise ValueError('trailer has no /Root')
+    return entries, root
+
+
+def _read_object(fp, entries, num):
+    location = entries.get(num)
+    if location is None:
+        raise ValueError(f'object {num} is not in the xref')
+    if location[0] == 'offset':
+        data = _read_from(fp, location[1], b'endobj')
+        header = OBJ_HEADER_RE.match(data)
+        if header is None or int(header.group(1)) != num:
+            raise ValueError(f'xref offset of object {num} is wrong')
+        return data[header.end():data.index(b'endobj')]
+    # object stored in an object stream
+    _, stream_num, stream_index = location
+    stream_location = entries.get(stream_num)
+    if stream_location is None or stream_location[0] != 'offset':
+        raise ValueError(f'object stream {stream_num} is not in the xref')
+    obj_dict, raw = _decode(fp, stream_location[1], _read_from(fp, stream_location[1], b'endobj'))
+    n, first = _int('N', obj_dict), _int('First', obj_dict)
+    if n is None or first is None or stream_index >= n:
+        raise ValueError(f'malformed object stream {stream_num}')
+    header = [int(i) for i in raw[:first].split()]
+    if header[2 * stream_index] != num:
+        raise ValueError(f'object {num} not found in object stream {stream_num}')
+    start = first + header[2 * stream_index + 1]
+    end = first + header[2 * stream_index + 3] if stream_index + 1 < n else len(raw)
+    return raw[start:end]
+
+
+def get_number_pages_fast(pdf_filename):
+    '''Read the page count from the /Count of the root page tree node, only parsing the trailer,
+       the cross-reference sections and the two objects needed. Raises ValueError for anything
+       unexpected, including valid PDFs it does not support (e.g. indirect stream lengths).'''
+    with open(pdf_filename, 'rb') as fp:
+        try:
+            entries, root = _read_xref(fp)
+            pages = _ref('Pages', _read_object(fp, entries, root))
+            if pages is None:
+                raise ValueError('catalog has no /Pages')
+            page_tree = _read_object(fp, entries, pages)
+        except (IndexError, zlib.error) as e:
+            raise ValueError(str(e)) from e
+    count = _int('Count', page_tree)
+    if not re.search(rb'/Type\s*/Pages\b', page_tree) or not count:
+        raise ValueError('root page tree node has no valid /Count')
+    return count
+
+
+def get_number_pages(pdf_filename):
+    try:
+        return get_number_pages_fast(pdf_filename)
+    except ValueError:
+        # broken or unusual file, let pypdf repair what it can
+        with open(pdf_filename, 'rb') as cur_pdf_fh:
+            cur_pdf = pypdf.PdfReader(cur_pdf_fh)
+            return len(cur_pdf.pages)
+
+
+def count_pages(pdf_filenames, jobs=None):
+    '''Page counts of all given files, in the same order, read concurrently.'''
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        return list(pool.map(get_number_pages, pdf_filenames))
+
+
+def find_pdfs(paths):
+    pdfs = []
+    for path in map(Path, paths):
+        pdfs.extend(sorted(path.rglob('*.pdf')) if path.is_dir() else [path])
+    return pdfs
+
+
+def page_budget_report(paths, max_pages, jobs=None):
+    pdfs = find_pdfs(paths)
+    page_counts = count_pages(pdfs, jobs)
+    over_budget = [(pdf, pages) for pdf, pages in zip(pdfs, page_counts) if pages > max_pages]
+    width = max((len(str(pdf)) for pdf in pdfs), default=0)
+    for pdf, pages in sorted(zip(pdfs, page_counts), key=lambda p: -p[1]):
+        print(f'{str(pdf):<{width}}  {pages:>3}{"  OVER LIMIT" if pages > max_pages else ""}')
+    print(f'\n{len(pdfs)} papers, {sum(page_counts)} pages in total, '
+          f'{len(over_budget)} papers over the limit of {max_pages} pages')
+    return over_budget
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Report the page count of PDFs and flag those over the page limit")
+    parser.add_argument("paths", nargs='+', help="PDF files, or directories to search for PDFs (e.g. the CMT camera-ready export)")
+    parser.add_argument("-m", "--max_pages", type=int, required=True, help="maximum number of pages per paper, including references")
+    parser.add_argument("-j", "--jobs", type=int, help="number of files to read concurrently (default: number of CPUs)")
+
+    args = parser.parse_args()
+    if page_budget_report(args.paths, args.max_pages, args.jobs):
+        sys.exit(1)
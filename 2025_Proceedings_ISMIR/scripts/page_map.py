@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+'''Page map of the proceedings: for every session the page of its title page, and for every paper
+its page range, both as pages of the PDF file and as printed in the page footers. Computed once
+from the session order and the page counts in the metadata, and checked against the bookmarks of
+the compiled proceedings, so that splitting (step 4) and the final outputs (step 6) don't each need
+to re-derive it from a start page.'''
+import json
+import re
+
+import pypdf
+
+from paper_metadata import load_papers, papers_by_id
+
+
+# bookmark mismatches listed when they stop the split
+MAX_LISTED = 10
+
+
+def compute_page_map(session_order, papers, start_page=None, printed_start_page=None):
+    '''Lay out the sessions the way papers.tex does: a session title page on a right-hand (odd) page,
+       followed by a blank page and the papers, and a blank page after the last paper if needed for the
+       next title page to be on a right-hand page. start_page is the page of the first session title page
+       in the PDF file and printed_start_page its number in the page footers; either may be None if
+       unknown, in which case the corresponding page numbers in the map are None.'''
+    def pdf_page(offset):
+        return None if start_page is None else start_page + offset
+
+    def printed_page(offset):
+        return None if printed_start_page is None else printed_start_page + offset
+
+    # offsets from the first session title page; like the original split, the next title page goes
+    # on an odd page of the PDF file, or of the page footers if only those page numbers are known
+    base = next((page for page in (start_page, printed_start_page) if page is not None), 1)
+    sessions = []
+    header = 0
+    for session in session_order:
+        entries = []
+        # skip the session title page and the blank page after it
+        first = header + 2
+        for paper_id in session["papers"]:
+            last = first + papers[paper_id].extra.num_pages - 1
+            entries.append({
+                "submission_id": paper_id,
+                "first_page": pdf_page(first),
+                "last_page": pdf_page(last),
+                "printed_first_page": printed_page(first),
+                "printed_last_page": printed_page(last),
+                "blank_pages": [],
+            })
+            first = last + 1
+        next_header = first + 1 if (base + first) % 2 == 0 else first
+        if entries and next_header > first:
+            entries[-1]["blank_pages"].append(pdf_page(first))
+        sessions.append({
+            "name": session["name"],
+            "header_page": pdf_page(header),
+            "printed_header_page": printed_page(header),
+            "blank_page": pdf_page(header + 1),
+            "papers": entries,
+        })
+        header = next_header
+    return {
+        "start_page": start_page,
+        "printed_start_page": printed_start_page,
+        "sessions": sessions,
+    }
+
+
+def paper_entries(page_map):
+    '''The paper entries of a page map in the order of the proceedings, with the session name added.'''
+    return [dict(entry, session=session["name"]) for session in page_map["sessions"] for entry in session["papers"]]
+
+
+def _normalize(title):
+    return re.sub(r'\W+', '', title).lower()
+
+
+def outline_pages(reader):
+    '''(title, page) of all bookmarks of the PDF, with 1-based page numbers.'''
+    entries = []
+    stack = [reader.outline]
+    while stack:
+        items = stack.pop()
+        for i, item in enumerate(items):
+            if isinstance(item, list):
+                # visit the children before the next sibling
+                stack.extend([items[i + 1:], item])
+                break
+            page = reader.get_destination_page_number(item)
+            if page is not None and page >= 0:
+                entries.append((item.title, page + 1))
+    return entries
+
+
+def find_start_page(reader, session_order, papers):
+    '''The page of the first session title page in the PDF, from the bookmark of the first paper.'''
+    first_id = next(paper_id for session in session_order for paper_id in session["papers"])
+    title = _normalize(papers[first_id].title)
+    for outline_title, page in outline_pages(reader):
+        if _normalize(outline_title) == title:
+            return page - 2
+    raise ValueError(f'No bookmark found for the first paper "{papers[first_id].title}", use --start_page')
+
+
+def printed_page_offset(reader):
+    '''Difference between the printed page numbers and the PDF page numbers of the main matter, from
+       the page labels of the PDF, or None if it has none.'''
+    if '/PageLabels' not in reader.trailer['/Root']:
+        return None
+    labels = reader.page_labels
+    # the last page is in the main matter or back matter, which continue the arabic page numbers
+    if not labels[-1].isdigit():
+        return None
+    return int(labels[-1]) - len(labels)
+
+
+def check_page_map(page_map, reader, papers):
+    '''Compare the page map with the compiled proceedings: the papers must fit in the PDF, and every
+       paper should start on a page that a bookmark points to. Returns the errors and the warnings. A few
+       missing or differently titled bookmarks are warnings, as the bookmarks may differ from the metadata,
+       but if the first paper or most papers do not match, the page map is off (a wrong start page, or a
+       page map of an earlier build) and the mismatches are errors.'''
+    errors = []
+    mismatches = {}
+    num_pages = len(reader.pages)
+    bookmarks = {}
+    for title, page in outline_pages(reader):
+        bookmarks.setdefault(page, []).append(title)
+    entries = paper_entries(page_map)
+    for entry in entries:
+        paper = papers[entry["submission_id"]]
+        first_page = entry["first_page"]
+        if entry["last_page"] > num_pages:
+            errors.append(f'{entry["submission_id"]} ({paper.title}): ends on page {entry["last_page"]}, '
+                          f'but the proceedings have {num_pages} pages')
+        elif first_page not in bookmarks:
+            mismatches[entry["submission_id"]] = (f'{entry["submission_id"]} ({paper.title}): no bookmark points '
+                                                  f'to its first page {first_page}')
+        elif _normalize(paper.title) not in map(_normalize, bookmarks[first_page]):
+            mismatches[entry["submission_id"]] = (f'{entry["submission_id"]} ({paper.title}): the bookmark on its '
+                                                  f'first page {first_page} is "{bookmarks[first_page][0]}"')
+    if not bookmarks:
+        return errors, ['the proceedings have no bookmarks, the first pages of the papers are not checked']
+    first_mismatch = bool(entries) and entries[0]["submission_id"] in mismatches
+    if first_mismatch or 2 * len(mismatches) > len(entries):
+        shown = list(mismatches.values())[:MAX_LISTED]
+        if len(mismatches) > len(shown):
+            shown.append(f'... and {len(mismatches) - len(shown)} more')
+        errors.append(f'{len(mismatches)} of {len(entries)} papers{", including the first," if first_mismatch else ""} '
+                      f'do not start on their bookmark: wrong start page or outdated page map?')
+        return errors + shown, []
+    return errors, list(mismatches.values())
+
+
+def report_problems(errors, warnings):
+    '''Print the warnings of check_page_map, and raise ValueError if there are errors.'''
+    for warning in warnings:
+        print(f'WARNING: {warning}')
+    if errors:
+        raise ValueError('The page map does not match the proceedings:\n' + '\n'.join(errors))
+
+
+def load_page_map(path):
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def check_session_order(page_map, session_order):
+    '''Raise ValueError if the page map was computed for a different session order.'''
+    expected = [(session["name"], session["papers"]) for session in session_order]
+    actual = [(session["name"], [entry["submission_id"] for entry in session["papers"]])
+              for session in page_map["sessions"]]
+    if expected != actual:
+        raise ValueError('The page map does not match the session order, regenerate it with page_map.py')
+
+
+def main(proceedings_path, metadata, session_order_name, output_path, start_page=None, printed_start_page=None):
+    with open(session_order_name, encoding='utf-8') as fp:
+        session_order = json.load(fp)
+    papers = papers_by_id(load_papers(metadata))
+    reader = pypdf.PdfReader(proceedings_path)
+
+    if start_page is None:
+        start_page = find_start_page(reader, session_order, papers)
+    if printed_start_page is None:
+        offset = printed_page_offset(reader)
+        printed_start_page = None if offset is None else start_page + offset
+    page_map = compute_page_map(session_order, papers, start_page, printed_start_page)
+    page_map["proceedings"] = str(proceedings_path)
+
+    report_problems(*check_page_map(page_map, reader, papers))
+    if printed_start_page is not None and (start_page - printed_start_page) % 2:
+        print(f'WARNING: the first session title page is on PDF page {start_page} but printed page '
+              f'{printed_start_page}, the title pages are placed on odd pages of the PDF file')
+
+    with open(output_path, 'w', encoding='utf-8') as fp:
+        json.dump(page_map, fp, indent=4, ensure_ascii=False)
+    entries = paper_entries(page_map)
+    print(f'Page map of {len(entries)} papers in {len(session_order)} sessions written to {output_path}, '
+          f'first session title page: PDF page {start_page}, printed page {printed_start_page}')
+    if printed_start_page is None:
+        print('WARNING: the PDF has no page labels, pass --printed_start_page for the printed page numbers')
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Compute the page ranges of all papers in the proceedings and check them against its bookmarks")
+    parser.add_argument("proceedings", help="The complete proceedings document")
+    parser.add_argument("metadata", help="JSON containing metadata generated from CSV")
+    parser.add_argument("order", help="JSON file describing sections and paper order")
+    parser.add_argument("-o", "--output", required=True, help="output page map JSON file")
+    parser.add_argument("-s", "--start_page", type=int, help="page in the PDF file of the first session title page (default: from the bookmark of the first paper)")
+    parser.add_argument("--printed_start_page", type=int, help="page number in the footer of the first session title page (default: from the page labels of the PDF)")
+
+    args = parser.parse_args()
+    try:
+        main(args.proceedings, args.metadata, args.order, args.output, args.start_page, args.printed_start_page)
+    except ValueError as e:
+        sys.exit(str(e))
@@ -5,48 +5,34 @@ Resume Zenodo upload by identifying already-uploaded papers and skipping them.
 import json
 import os
 import sys
-import requests
+from pathlib import Path
 
-def get_uploaded_papers(token):
-    """Get all ISMIR 2025 papers already uploaded to Zenodo."""
-    resp = requests.get(
-        'https://zenodo.org/api/deposit/depositions',
-        params={'access_token': token, 'size': 200}
-    )
-    
-    if resp.status_code != 200:
-        print(f'Error listing deposits: {resp.status_code}')
-        return {}
-    
-    deposits = resp.json()
-    
-    # Find ISMIR 2025 papers uploaded today
-    uploaded_map = {}
-    for d in deposits:
-        created = d.get('created', '')
-        if '2025-11-25' not in created:
-            continue
-            
-        files = d.get('files', [])
-        if not files:
-            continue
-            
-        filename = files[0]['filename']
-        title = d.get('metadata', {}).get('title', '')
-        doi = d.get('doi', '')
-        zid = d.get('id')
-        
-        # Check if it's an ISMIR 2025 paper (has proper metadata)
-        if title and doi and filename.endswith('.pdf'):
-            uploaded_map[filename] = {
-                'zenodo_id': zid,
-                'doi': doi,
-                'title': title[:80]
-            }
-    
-    return uploaded_map
+from zenodo_upload import API_URLS, DepositionIndex, ZenodoClient, ZenodoError, file_md5
 
-def create_resume_json(input_json, uploaded_map, output_json):
+def get_uploaded_papers(client, jobs=4):
+    """Index all depositions of the account by file name and checksum, following the pagination."""
+    depositions = client.list_depositions(jobs)
+    print(f'Listed {len(depositions)} depositions')
+    return DepositionIndex(depositions)
+
+def find_uploaded(paper, index, pdf_dir=None):
+    """The published deposition of a paper: one with the same file content, or without the split
+    files, one with the same file name and title (file names repeat across years)."""
+    filename = paper['ee'].split('/')[-1]
+    if pdf_dir:
+        candidates = index.by_checksum.get(file_md5(Path(pdf_dir) / filename), [])
+    else:
+        candidates = [d for d in index.by_file.get(filename, [])
+                      if d.get('metadata', {}).get('title') == paper['title']]
+    published = [d for d in candidates if d.get('submitted') and d.get('doi')]
+    if len(published) > 1:
+        print(f'⚠ {filename} was published {len(published)} times: '
+              + ', '.join(str(d['id']) for d in published))
+    if not published and candidates:
+        print(f'⚠ {filename} has unpublished depositions: ' + ', '.join(str(d['id']) for d in candidates))
+    return published[0] if published else None
+
+def create_resume_json(input_json, index, output_json, pdf_dir=None):
     """Create a JSON with only papers that haven't been uploaded yet."""
     with open(input_json, 'r') as f:
         all_papers = json.load(f)
@@ -56,14 +42,15 @@ def create_resume_json(input_json, uploaded_map, output_json):
     
     for paper in all_papers:
         filename = paper['ee'].split('/')[-1]
+        deposition = find_uploaded(paper, index, pdf_dir)
         
-        if filename in uploaded_map:
+        if deposition:
             # Already uploaded - update with Zenodo info
             paper_with_zenodo = paper.copy()
-            paper_with_zenodo['zenodo_id'] = uploaded_map[filename]['zenodo_id']
-            paper_with_zenodo['doi'] = uploaded_map[filename]['doi']
-            paper_with_zenodo['url'] = f"https://doi.org/{uploaded_map[filename]['doi']}"
-            paper_with_zenodo['ee'] = f"https://zenodo.org/record/{uploaded_map[filename]['zenodo_id']}/files/{filename}"
+            paper_with_zenodo['zenodo_id'] = deposition['id']
+            paper_with_zenodo['doi'] = deposition['doi']
+            paper_with_zenodo['url'] = f"https://doi.org/{deposition['doi']}"
+            paper_with_zenodo['ee'] = f"https://zenodo.org/record/{deposition['id']}/files/{filename}"
             already_uploaded.append(paper_with_zenodo)
             print(f'✓ Already uploaded: {filename} - {paper["title"][:60]}...')
         else:
@@ -82,21 +69,23 @@ def create_resume_json(input_json, uploaded_map, output_json):
     
     return len(already_uploaded), len(remaining_papers)
 
-def main():
+def main(input_json, output_json, pdf_dir=None, api_url=API_URLS['prod'], jobs=4):
     token = os.environ.get('ZENODO_TOKEN_PROD')
     if not token:
         print('Error: ZENODO_TOKEN_PROD not set')
         sys.exit(1)
     
-    input_json = 'ismir2025-proceedings-final/2025_clean.json'
-    output_json = 'ismir2025-proceedings-final/2025_remaining.json'
-    
     print('Step 1: Checking Zenodo for already-uploaded papers...')
-    uploaded_map = get_uploaded_papers(token)
-    print(f'\n✓ Found {len(uploaded_map)} already-uploaded ISMIR 2025 papers on Zenodo')
+    client = ZenodoClient(api_url, token, pool_size=jobs)
+    try:
+        index = get_uploaded_papers(client, jobs)
+    except ZenodoError as e:
+        print(f'Error listing deposits: {e}')
+        sys.exit(1)
+    print(f'\n✓ Found {len(index.by_file)} file names and {len(index.by_checksum)} distinct files on Zenodo')
     
     print('\nStep 2: Creating filtered JSON...')
-    completed, remaining = create_resume_json(input_json, uploaded_map, output_json)
+    completed, remaining = create_resume_json(input_json, index, output_json, pdf_dir)
     
     print(f'\n=== Summary ===')
     print(f'✓ Already uploaded: {completed} papers')
@@ -112,5 +101,14 @@ def main():
     print(f'    --num_cpus 1')
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Find the papers already uploaded to Zenodo and write the JSON of the remaining ones")
+    parser.add_argument("--input", default='ismir2025-proceedings-final/2025_clean.json', help="final JSON of all papers")
+    parser.add_argument("--output", default='ismir2025-proceedings-final/2025_remaining.json', help="JSON of the papers still to upload (the uploaded ones go to *_completed.json)")
+    parser.add_argument("--pdf_dir", help="directory of the split papers, to match them to depositions by checksum instead of by file name and title")
+    parser.add_argument("--api_url", default=API_URLS['prod'], help="URL of the Zenodo API")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="number of pages of depositions to fetch concurrently")
+
+    args = parser.parse_args()
+    main(args.input, args.output, args.pdf_dir, args.api_url, args.jobs)
 
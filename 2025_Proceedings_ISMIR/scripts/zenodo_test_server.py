@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+'''A local stand-in for the deposition API of Zenodo, to test zenodo_upload.py and resume_upload.py
+without an account. It lists, creates, updates, edits and publishes depositions, creates new versions
+and takes file uploads. Like Zenodo, it rewrites the HTML of the descriptions. Everything is kept in
+memory, including the files, which are kept only as their checksums. Latency, server errors and a rate
+limit can be added to every request.'''
+import hashlib
+import html
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# fields of the metadata without which a deposition cannot be published
+REQUIRED_METADATA = ('upload_type', 'title', 'creators', 'description')
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+
+
+def sanitize(description):
+    '''A description as Zenodo stores it: the text outside the tags is escaped, whitespace is collapsed
+       and plain text is put in a paragraph.'''
+    parts = re.split(r'(</?[A-Za-z][^<>]*>)', description)
+    text = ''.join(part if i % 2 else html.escape(html.unescape(part), quote=False) for i, part in enumerate(parts))
+    text = ' '.join(text.split())
+    return text if text.startswith('<') else f'<p>{text}</p>'
+
+
+def clean_metadata(metadata):
+    metadata = dict(metadata or {})
+    if metadata.get('description'):
+        metadata['description'] = sanitize(metadata['description'])
+    return metadata
+
+
+class ZenodoTestServer(ThreadingHTTPServer):
+    '''The test server, on port (0 for any free port) of localhost. Every request is delayed by latency
+       seconds, a fraction failure_rate of them fails with a 503 before it has any effect, and beyond
+       rate_limit requests per second the requests fail with a 429. The counts of the requests per
+       endpoint are in stats.'''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, failure_rate=0.0, rate_limit=None, seed=None):
+        super().__init__(('127.0.0.1', port), ZenodoHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.depositions = {}
+        self.buckets = {}
+        self.next_id = 1
+        self.stats = Counter()
+        self.recent = deque()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/api'
+
+    def handle_error(self, request, client_address):
+        # a client that was stopped or gave up on a request
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        '''Serve in a background thread.'''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def admit(self, endpoint):
+        '''Count a request and decide whether it is served: raises ApiError for rate limited and failing requests.'''
+        with self.lock:
+            self.stats[endpoint] += 1
+            if self.rate_limit:
+                current = time.monotonic()
+                while self.recent and self.recent[0] < current - 1:
+                    self.recent.popleft()
+                if len(self.recent) >= self.rate_limit:
+                    self.stats['rate limited'] += 1
+                    raise ApiError(429, 'Too many requests')
+                self.recent.append(current)
+            if self.random.random() < self.failure_rate:
+                self.stats['failed'] += 1
+                raise ApiError(503, 'Injected failure')
+
+    def new_deposition(self, metadata=None, files=(), concept_id=None):
+        with self.lock:
+            deposition_id = self.next_id
+            self.next_id += 1
+        bucket = uuid.uuid4().hex
+        deposition = {
+            'id': deposition_id,
+            'record_id': deposition_id,
+            'conceptrecid': str(concept_id or deposition_id),
+            'created': now(),
+            'modified': now(),
+            'state': 'unsubmitted',
+            'submitted': False,
+            'doi': '',
+            'metadata': dict(metadata or {}, prereserve_doi={'doi': f'10.5072/zenodo.{deposition_id}',
+                                                              'recid': deposition_id}),
+            'files': [dict(file) for file in files],
+            'bucket': bucket,
+        }
+        self.depositions[deposition_id] = deposition
+        self.buckets[bucket] = deposition_id
+        return deposition
+
+    def deposition(self, deposition_id):
+        try:
+            return self.depositions[int(deposition_id)]
+        except KeyError:
+            raise ApiError(404, f'Deposition {deposition_id} not found') from None
+
+    def to_json(self, deposition):
+        '''A deposition as the API returns it, with the links to its actions.'''
+        record = {name: value for name, value in deposition.items() if name != 'bucket'}
+        url = f'{self.url}/deposit/depositions/{deposition["id"]}'
+        record['links'] = {
+            'self': url,
+            'bucket': f'{self.url}/files/{deposition["bucket"]}',
+            'publish': f'{url}/actions/publish',
+            'edit': f'{url}/actions/edit',
+            'newversion': f'{url}/actions/newversion',
+        }
+        return record
+
+
+class ZenodoHandler(BaseHTTPRequestHandler):
+    # keep the connections open, as the connection pool of the client expects
+    protocol_version = 'HTTP/1.1'
+    routes = [
+        ('GET', r'/api/deposit/depositions', 'list'),
+        ('POST', r'/api/deposit/depositions', 'create'),
+        ('GET', r'/api/deposit/depositions/(\d+)', 'get'),
+        ('PUT', r'/api/deposit/depositions/(\d+)', 'update'),
+        ('POST', r'/api/deposit/depositions/(\d+)/actions/publish', 'publish'),
+        ('POST', r'/api/deposit/depositions/(\d+)/actions/edit', 'edit'),
+        ('POST', r'/api/deposit/depositions/(\d+)/actions/newversion', 'newversion'),
+        ('PUT', r'/api/files/(\w+)/([^/]+)', 'upload'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def route(self, method, path):
+        '''The name of the endpoint and the arguments from the path, or None.'''
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return name, match.groups()
+        return None
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        route = self.route(method, url.path)
+        # the whole body is read first, so that the connection can be used for the next request
+        self.uploaded = self.read_upload() if route and route[0] == 'upload' else None
+        self.body = self.rfile.read(int(self.headers.get('Content-Length', 0))) if not self.uploaded else b''
+        time.sleep(self.server.latency)
+        try:
+            if route is None:
+                raise ApiError(404, f'No such endpoint: {method} {url.path}')
+            if not self.headers.get('Authorization', '').removeprefix('Bearer ').strip():
+                raise ApiError(401, 'No access token')
+            name, arguments = route
+            self.server.admit(name)
+            with self.server.lock:
+                status, response = getattr(self, name)(*arguments, query=parse_qs(url.query))
+        except ApiError as e:
+            status, response = e.status, {'status': e.status, 'message': str(e)}
+        self.respond(status, response)
+
+    def read_upload(self):
+        '''MD5 and size of the uploaded file, read in blocks.'''
+        digest = hashlib.md5()
+        remaining = int(self.headers.get('Content-Length', 0))
+        size = 0
+        while remaining:
+            block = self.rfile.read(min(remaining, 2**20))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+            size += len(block)
+        return digest.hexdigest(), size
+
+    def json_body(self):
+        try:
+            return json.loads(self.body or b'{}')
+        except ValueError:
+            raise ApiError(400, 'Invalid JSON') from None
+
+    def list(self, query):
+        page = int(query.get('page', ['1'])[0])
+        size = int(query.get('size', ['10'])[0])
+        depositions = sorted(self.server.depositions.values(), key=lambda deposition: -deposition['id'])
+        return 200, [self.server.to_json(deposition) for deposition in depositions[(page - 1) * size:page * size]]
+
+    def create(self, query):
+        return 201, self.server.to_json(self.server.new_deposition(clean_metadata(self.json_body().get('metadata'))))
+
+    def get(self, deposition_id, query):
+        return 200, self.server.to_json(self.server.deposition(deposition_id))
+
+    def update(self, deposition_id, query):
+        deposition = self.server.deposition(deposition_id)
+        if deposition['state'] == 'done':
+            raise ApiError(400, 'The deposition is published, edit it first')
+        metadata = clean_metadata(self.json_body().get('metadata'))
+        metadata['prereserve_doi'] = deposition['metadata']['prereserve_doi']
+        deposition['metadata'] = metadata
+        deposition['modified'] = now()
+        return 200, self.server.to_json(deposition)
+
+    def publish(self, deposition_id, query):
+        deposition = self.server.deposition(deposition_id)
+        if deposition['state'] == 'done':
+            raise ApiError(400, 'The deposition is already published')
+        missing = [name for name in REQUIRED_METADATA if not deposition['metadata'].get(name)]
+        if missing:
+            raise ApiError(400, f'Missing metadata: {", ".join(missing)}')
+        if not deposition['files']:
+            raise ApiError(400, 'The deposition has no files')
+        deposition.update(state='done', submitted=True, doi=deposition['metadata']['prereserve_doi']['doi'],
+                          modified=now())
+        return 202, self.server.to_json(deposition)
+
+    def edit(self, deposition_id, query):
+        deposition = self.server.deposition(deposition_id)
+        if deposition['state'] != 'done':
+            raise ApiError(400, 'Only published depositions can be edited')
+        deposition['state'] = 'inprogress'
+        return 201, self.server.to_json(deposition)
+
+    def newversion(self, deposition_id, query):
+        deposition = self.server.deposition(deposition_id)
+        if not deposition['submitted']:
+            raise ApiError(400, 'Only published depositions can have new versions')
+        metadata = {name: value for name, value in deposition['metadata'].items() if name != 'prereserve_doi'}
+        draft = self.server.new_deposition(metadata, deposition['files'], deposition['conceptrecid'])
+        response = self.server.to_json(deposition)
+        response['links']['latest_draft'] = f'{self.server.url}/deposit/depositions/{draft["id"]}'
+        return 201, response
+
+    def upload(self, bucket, filename, query):
+        if bucket not in self.server.buckets:
+            raise ApiError(404, f'Bucket {bucket} not found')
+        deposition = self.server.depositions[self.server.buckets[bucket]]
+        # the files of a published version cannot be changed, also not while its metadata is edited
+        if deposition['submitted']:
+            raise ApiError(403, 'The bucket is locked')
+        md5, size = self.uploaded
+        file = {'id': uuid.uuid4().hex, 'filename': filename, 'filesize': size, 'checksum': md5}
+        deposition['files'] = [existing for existing in deposition['files'] if existing['filename'] != filename] + [file]
+        return 201, {'key': filename, 'size': size, 'checksum': f'md5:{md5}', 'created': now()}
+
+    def respond(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the deposition API of Zenodo, for testing the upload")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="port to listen on, on localhost")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every request in seconds")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="fraction of the requests that fail with a server error")
+    parser.add_argument("--rate_limit", type=int, help="number of requests per second beyond which requests are rate limited")
+    parser.add_argument("--seed", type=int, help="seed of the random failures")
+
+    args = parser.parse_args()
+    server = ZenodoTestServer(args.port, args.latency, args.failure_rate, args.rate_limit, args.seed)
+    print(f'Serving the Zenodo API at {server.url}, upload with --api_url {server.url} (any token will do)', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'Requests: {dict(server.stats)}')
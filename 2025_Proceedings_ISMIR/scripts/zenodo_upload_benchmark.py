@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+'''Upload throughput and resume correctness of zenodo_upload.py, against the local test server of
+zenodo_test_server.py and synthetic proceedings. The upload is run as it would be by hand, again after
+a failed run until all papers are published, and checked against the depositions on the server.'''
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from paper_metadata import Paper, dump_papers
+from zenodo_test_server import ZenodoTestServer
+from zenodo_upload import file_md5
+
+
+UPLOAD_SCRIPT = Path(__file__).with_name('zenodo_upload.py')
+# runs of the upload after which the papers that still fail are given up on
+MAX_RUNS = 10
+
+
+def make_proceedings(directory, num_papers=200, size=300_000, seed=0):
+    '''Final JSON and split files of num_papers papers. The split files are random bytes, size bytes on
+       average, since the upload does not look inside them. Returns the total size of the files.'''
+    rng = random.Random(seed)
+    split_dir = directory / 'split_articles'
+    split_dir.mkdir()
+    papers = []
+    total = 0
+    page = 1
+    for i in range(1, num_papers + 1):
+        data = rng.randbytes(rng.randint(size // 2, size * 3 // 2))
+        (split_dir / f'{i:03d}.pdf').write_bytes(data)
+        total += len(data)
+        num_pages = rng.randint(4, 8)
+        papers.append(Paper(title=f'Paper {i}', author=[f'Author {i}', 'Ludwig van Beethoven'], year='2026',
+                            pages=f'{page}-{page + num_pages - 1}',
+                            # rewritten by the server, as Zenodo does, which must not count as a change
+                            abstract=f'Abstract of paper {i}: pitch & rhythm  at tempo <= {60 + i} BPM.\n<i>Keys</i>',
+                            ee=f'https://archives.ismir.net/ismir2026/paper/{i:03d}.pdf'))
+        page += num_pages
+    dump_papers(papers, directory / '202x.json', public=True)
+    return total
+
+
+def start_upload(server, directory, jobs, backoff, check_remote=False):
+    command = [sys.executable, str(UPLOAD_SCRIPT), str(directory / '202x.json'), str(directory / 'split_articles'),
+               str(directory / 'zenodo.json'), '--api_url', server.url, '--jobs', str(jobs), '--backoff', str(backoff)]
+    if check_remote:
+        command.append('--check_remote')
+    return subprocess.Popen(command, env=dict(os.environ, ZENODO_TOKEN_DEV='test'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+def upload(server, directory, jobs, backoff, check_remote=False):
+    '''Run the upload until it succeeds. Returns the wall time and the number of runs.'''
+    start = time.perf_counter()
+    for run in range(1, MAX_RUNS + 1):
+        process = start_upload(server, directory, jobs, backoff, check_remote)
+        _, stderr = process.communicate()
+        if process.returncode == 0:
+            break
+        if stderr:
+            raise RuntimeError(f'The upload failed:\n{stderr}')
+    return time.perf_counter() - start, run
+
+
+def check(server, directory):
+    '''Compare the output of the upload with the depositions on the server: every paper must have been
+       published once, with its file and title, and the output must point to it. Returns the problems
+       and the number of depositions left unpublished, which an interrupted upload may leave behind if
+       it is stopped between creating a deposition and recording it in the journal.'''
+    problems = []
+    published = {}
+    drafts = 0
+    for deposition in server.depositions.values():
+        if not deposition['submitted']:
+            drafts += 1
+        for file in deposition['files'] if deposition['submitted'] else []:
+            published.setdefault(file['filename'], []).append(deposition)
+    with open(directory / 'zenodo.json', encoding='utf-8') as fp:
+        output = json.load(fp)
+    for record in output:
+        file = record['ee'].split('/')[-1]
+        depositions = published.get(file, [])
+        if len(depositions) != 1:
+            problems.append(f'{file}: published {len(depositions)} times')
+        elif (depositions[0]['id'], depositions[0]['doi']) != (record['zenodo_id'], record['doi']):
+            problems.append(f'{file}: the output points to {record["zenodo_id"]} instead of {depositions[0]["id"]}')
+        elif depositions[0]['files'][0]['checksum'] != file_md5(directory / 'split_articles' / file):
+            problems.append(f'{file}: the published file differs')
+        elif depositions[0]['metadata']['title'] != record['title']:
+            problems.append(f'{file}: published with the title "{depositions[0]["metadata"]["title"]}"')
+    return problems, drafts
+
+
+def report(problems, drafts):
+    status = 'ok' if not problems else f'{len(problems)} PROBLEMS'
+    if drafts:
+        status += f', {drafts} unpublished depositions left'
+    print(f'  check: {status}')
+    for problem in problems:
+        print(f'    {problem}')
+
+
+def request_counts(server):
+    failed = server.stats['failed'] + server.stats['rate limited']
+    return sum(server.stats.values()) - failed, server.stats['failed'], server.stats['rate limited']
+
+
+def reset(directory):
+    for name in ('zenodo.json', 'zenodo.journal.jsonl'):
+        (directory / name).unlink(missing_ok=True)
+
+
+def benchmark(num_papers=200, size=300_000, jobs_list=(1, 4, 8), latency=0.05, failure_rate=0.0, rate_limit=None,
+              backoff=0.1, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        total = make_proceedings(directory, num_papers, size, seed) / 2**20
+        print(f'{num_papers} papers, {total:.0f} MB; test server with {latency * 1000:.0f} ms latency, '
+              f'{failure_rate:.0%} failures, rate limit {rate_limit or "none"}')
+        problem_count = 0
+        times = {}
+        for jobs in jobs_list:
+            reset(directory)
+            server = ZenodoTestServer(latency=latency, failure_rate=failure_rate, rate_limit=rate_limit, seed=seed).start()
+            elapsed, runs = upload(server, directory, jobs, backoff)
+            times[jobs] = elapsed
+            served, failed, limited = request_counts(server)
+            print(f'--jobs {jobs}: {elapsed:.1f}s in {runs} run{"s" if runs > 1 else ""}, {num_papers / elapsed:.1f} papers/s, '
+                  f'{total / elapsed:.1f} MB/s, {served} requests ({failed} failed, {limited} rate limited)')
+            problems, drafts = check(server, directory)
+            report(problems, drafts)
+            problem_count += len(problems)
+
+            before = sum(server.stats.values())
+            elapsed, _ = upload(server, directory, jobs, backoff)
+            print(f'  rerun: {elapsed:.1f}s, {sum(server.stats.values()) - before} requests')
+
+            # the depositions are read back, and none may be edited
+            before = Counter(server.stats)
+            elapsed, _ = upload(server, directory, jobs, backoff, check_remote=True)
+            changes = Counter(server.stats) - before
+            edits = changes['edit'] + changes['newversion'] + changes['update']
+            print(f'  rerun with --check_remote: {elapsed:.1f}s, {sum(changes.values())} requests, {edits} edits')
+            if edits:
+                print(f'    PROBLEM: {edits} requests changed depositions that were up to date')
+                problem_count += 1
+            server.stop()
+
+        # kill the upload halfway and resume it
+        jobs = max(jobs_list)
+        reset(directory)
+        server = ZenodoTestServer(latency=latency, failure_rate=failure_rate, rate_limit=rate_limit, seed=seed).start()
+        process = start_upload(server, directory, jobs, backoff)
+        time.sleep(times[jobs] / 2)
+        process.kill()
+        process.wait()
+        with open(directory / 'zenodo.journal.jsonl', encoding='utf-8') as fp:
+            done = sum('"published"' in line for line in fp)
+        elapsed, runs = upload(server, directory, jobs, backoff)
+        print(f'resume with --jobs {jobs} after killing the upload at {done} of {num_papers} papers: '
+              f'{elapsed:.1f}s in {runs} run{"s" if runs > 1 else ""}')
+        problems, drafts = check(server, directory)
+        report(problems, drafts)
+        problem_count += len(problems)
+        server.stop()
+    return problem_count
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure the upload throughput of zenodo_upload.py and check that it resumes correctly, against a local Zenodo test server")
+    parser.add_argument("-n", "--num_papers", type=int, default=200, help="number of synthetic papers")
+    parser.add_argument("--size", type=int, default=300_000, help="average size of the split files in bytes")
+    parser.add_argument("-j", "--jobs", type=int, nargs='+', default=[1, 4, 8], help="numbers of concurrent uploads to compare")
+    parser.add_argument("--latency", type=float, default=0.05, help="delay of every request in seconds")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="fraction of the requests that fail with a server error")
+    parser.add_argument("--rate_limit", type=int, help="number of requests per second beyond which requests are rate limited")
+    parser.add_argument("--backoff", type=float, default=0.1, help="--backoff of the upload")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic papers and the failures")
+
+    args = parser.parse_args()
+    if benchmark(args.num_papers, args.size, args.jobs, args.latency, args.failure_rate, args.rate_limit,
+                 args.backoff, args.seed):
+        sys.exit(1)
@@ -1,15 +1,7 @@
 #!/bin/bash -xue
 
-echo cleaning up...
-rm -f 202x_Proceedings_ISMIR.{aux,ain,log,out,toc}
-
-echo initial pdflatex...
-pdflatex 202x_Proceedings_ISMIR.tex
-
-echo perl script to generate authorindex...
-perl authorindex.pl 202x_Proceedings_ISMIR.aux
-
-echo final pdflatex...
-# running twice is safer
-pdflatex 202x_Proceedings_ISMIR.tex
-pdflatex 202x_Proceedings_ISMIR.tex
+# Compiles 202x_Proceedings_ISMIR.tex with as many pdflatex passes as needed and regenerates
+# the author index whenever it changes. Pass --clean to start from scratch, see
+# ../202x_scripts/build_proceedings.py --help for the other options.
+cd "$(dirname "$0")"
+python3 ../202x_scripts/build_proceedings.py 202x_Proceedings_ISMIR.tex "$@"
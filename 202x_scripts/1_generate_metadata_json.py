@@ -1,43 +1,21 @@
 import csv
 import json
-import copy
+import hashlib
+import os
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import pypdf
 import argparse
 import subprocess
 import datetime
+import time
+from page_count import count_pages
+from paper_metadata import Paper, Extra, dump_papers
 from titlecase_checker import get_csv_encoding, warnings
 
 
-key_template = {
-    "title": None,
-    "author": [],
-    "year": None,
-    "doi": None,
-    "url": None,
-    "pages": None,
-    "abstract": None,
-    "zenodo_id": None,
-    "dblp_key": None,
-    "ee": None,
-    "extra": {
-      "email": {},
-      "affiliation": {},
-      "takeaway": None,
-      "external_links": None,
-      "submission_id": None,
-      "session_id": None,
-      "session_position": None,
-    #   "special_call": None,
-      "subject_area_primary": None,
-      "subject_area_secondary": [],
-      "num_pages": None,
-      "file": None,
-      "split_file": None,
-      "original_file": None
-    }
-}
+GS_ARGS = ['-dNOPAUSE', '-dBATCH', '-sDEVICE=pdfwrite', '-dPDFSETTINGS=/prepress', '-dEmbedAllFonts=true']
 
 
 def process_authors(line):
@@ -69,101 +47,225 @@ def process_authors(line):
 
 
 def process_line(line, year):
-    paper = copy.deepcopy(key_template)
-    paper["title"] = line["Title"].strip()
-    paper["year"] = str(year)
-    paper["abstract"] = line["Abstract"].strip()
     authors, author_emails, author_affiliations = process_authors(line)
-    paper["author"] = authors
-    paper["extra"]["email"] = author_emails
-    paper["extra"]["affiliation"] = author_affiliations
-    # paper["extra"]["special_call"] = line["SpecialTrack"] == "Yes"
-    paper["extra"]["takeaway"] = line["OneLiner"].strip()
-    paper["extra"]["subject_area_primary"] = line["PrimarySubjectArea"]
-    sub_secondary = line["SecondarySubjectAreas"].split(';')
-    for index in range(len(sub_secondary)):
-        sub_secondary[index] = sub_secondary[index].strip()
-    paper["extra"]["subject_area_secondary"] = sub_secondary
-    paper["extra"]["submission_id"]  = int(line["PaperID"])
-    paper["extra"]["file"] = "paper_{:03d}.pdf".format(paper["extra"]["submission_id"])   
-    paper["extra"]["session_id"] = line["SessionID"].split(":")[0]
-    paper["extra"]["session_position"] = int(line["SessionID"].split(":")[1])
-    return paper
+    submission_id = int(line["PaperID"])
+    return Paper(
+        title=line["Title"].strip(),
+        author=authors,
+        year=str(year),
+        abstract=line["Abstract"].strip(),
+        extra=Extra(
+            email=author_emails,
+            affiliation=author_affiliations,
+            # special_call=line["SpecialTrack"] == "Yes",
+            takeaway=line["OneLiner"].strip(),
+            subject_area_primary=line["PrimarySubjectArea"],
+            subject_area_secondary=[s.strip() for s in line["SecondarySubjectAreas"].split(';')],
+            submission_id=submission_id,
+            file="paper_{:03d}.pdf".format(submission_id),
+            session_id=line["SessionID"].split(":")[0],
+            session_position=int(line["SessionID"].split(":")[1]),
+        )
+    )
 
 
-def get_number_pages(pdf_filename):
-    with open(pdf_filename, 'rb') as cur_pdf_fh:
-        cur_pdf = pypdf.PdfReader(cur_pdf_fh)
-        return len(cur_pdf.pages)
+def index_camera_ready(papersdir):
+    # walk the CMT export once: submission id -> PDFs in its CameraReady folder (None if there is no such folder)
+    index = {}
+    with os.scandir(papersdir) as submissions:
+        for submission in submissions:
+            if not submission.is_dir() or not submission.name.isdigit():
+                continue
+            try:
+                with os.scandir(os.path.join(submission.path, 'CameraReady')) as files:
+                    index[int(submission.name)] = sorted(Path(f.path) for f in files
+                                                         if f.is_file() and f.name.lower().endswith('.pdf'))
+            except FileNotFoundError:
+                index[int(submission.name)] = None
+    return index
 
 
-def process_paper(paper, papersdir):
-    paper_id = paper["extra"]["submission_id"]
-    try:
-        pdf_path = next(papersdir.glob(f'{paper_id}/CameraReady/*.pdf'))
-    except StopIteration:
-        raise Exception(f"Can't find a pdf for paper id {paper_id}") from None
-    paper["extra"]["num_pages"] = get_number_pages(pdf_path)
-    paper["extra"]["original_file"] = str(pdf_path)
+def check_camera_ready(paper_data, camera_ready):
+    problems = []
+    for paper in paper_data:
+        paper_id = paper.extra.submission_id
+        if paper_id not in camera_ready:
+            problems.append(f"Paper id {paper_id}: no submission folder")
+            continue
+        pdfs = camera_ready[paper_id]
+        if pdfs is None:
+            problems.append(f"Paper id {paper_id}: no CameraReady folder")
+        elif not pdfs:
+            problems.append(f"Paper id {paper_id}: can't find a pdf in the CameraReady folder")
+        elif len(pdfs) > 1:
+            problems.append(f"Paper id {paper_id}: several pdfs in the CameraReady folder ({', '.join(p.name for p in pdfs)})")
+    return problems
+
+
+def process_paper(paper, camera_ready):
+    paper.extra.original_file = str(camera_ready[paper.extra.submission_id][0])
 
     return paper
 
 
 def generate_session_dict(data, session_list):
-    session_keys = list(set([x["extra"]["session_id"] for x in data]))
-    # Ensure session lists match
-
-    csv_sess_list = copy.deepcopy(session_keys)
-    file_sess_list = copy.deepcopy(session_list)
-    csv_sess_list.sort()
-    file_sess_list.sort()
-    
-    assert file_sess_list == csv_sess_list
-    json_out = []
-
+    # group papers by session in a single pass, keyed on their position within the session
+    sessions = {}
+    problems = []
     for sess in session_list:
-        curr_papers = dict([(x["extra"]["session_position"], x["extra"]["submission_id"]) for x in data if x["extra"]["session_id"] == sess])
-        json_out.append({"name": sess, "papers": [curr_papers[subid] for subid in sorted(curr_papers)]})
+        if sess in sessions:
+            problems.append(f'Session "{sess}" appears more than once in the session list')
+        sessions[sess] = {}
+    for paper in data:
+        paper_id = paper.extra.submission_id
+        sess, position = paper.extra.session_id, paper.extra.session_position
+        if sess not in sessions:
+            problems.append(f'Session "{sess}" of paper {paper_id} is missing from the session list')
+        elif position in sessions[sess]:
+            problems.append(f'Papers {sessions[sess][position]} and {paper_id} both have position {position} in session "{sess}"')
+        else:
+            sessions[sess][position] = paper_id
+
+    json_out = []
+    for sess, papers in sessions.items():
+        if not papers:
+            problems.append(f'Session "{sess}" in the session list has no papers')
+        missing = sorted(set(range(1, max(papers, default=0) + 1)) - papers.keys())
+        if missing:
+            problems.append(f'Session "{sess}" has no paper at position(s) {", ".join(map(str, missing))}')
+        json_out.append({"name": sess, "papers": [papers[position] for position in sorted(papers)]})
+    if problems:
+        raise Exception("Inconsistent session assignment:\n" + "\n".join(problems))
     return json_out
 
 
-def main(csvfile, papersdir, sessions, outputfile, sessionfile, output_dir, year):
-    paper_data = []
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, encoding='utf-8') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_cache(cache, cache_path):
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        json.dump(cache, fp, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+
+
+def is_cache_hit(entry, source_hash, output_path):
+    # the output must still be the file gs wrote, not one modified or removed since
+    return (entry is not None and entry["source_sha256"] == source_hash and entry["gs_args"] == GS_ARGS
+            and output_path.exists() and output_path.stat().st_size == entry["output_size"])
+
+
+def convert_paper(paper, output_dir, log_dir, cache_entry=None):
+    output_path = output_dir / paper.extra.file
+    source_hash = file_sha256(paper.extra.original_file)
+    if is_cache_hit(cache_entry, source_hash, output_path):
+        return 0, None, cache_entry, True
+
+    # gs output goes to a log per paper, so parallel conversions don't interleave
+    log_path = log_dir / Path(paper.extra.file).with_suffix('.log')
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        result = subprocess.run([
+            'gs', *GS_ARGS,
+            f'-sOutputFile={output_path}',
+            '-f', paper.extra.original_file
+        ], stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        return result.returncode, log_path, None, False
+    entry = {
+        "original_file": paper.extra.original_file,
+        "source_sha256": source_hash,
+        "gs_args": GS_ARGS,
+        "output_size": output_path.stat().st_size,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    return 0, log_path, entry, False
+
+
+def convert_papers(paper_data, output_dir, log_dir, jobs, cache_path, force=False):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    cache = {} if force else load_cache(cache_path)
+    failures = []
+    hits = misses = 0
+    time_saved = 0.
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(convert_paper, d, output_dir, log_dir, cache.get(d.extra.file)): d
+                       for d in paper_data}
+            for future in as_completed(futures):
+                d = futures[future]
+                returncode, log_path, entry, cached = future.result()
+                if cached:
+                    hits += 1
+                    time_saved += entry["seconds"]
+                    status = 'unchanged, skipped'
+                else:
+                    misses += 1
+                    status = 'ok' if returncode == 0 else f'FAILED (gs exit code {returncode})'
+                print(f'{d.extra.submission_id} - {d.title}: {status}')
+                if returncode != 0:
+                    failures.append((d, returncode, log_path))
+                    cache.pop(d.extra.file, None)
+                else:
+                    cache[d.extra.file] = entry
+    finally:
+        save_cache(cache, cache_path)
+
+    print(f'Ghostscript cache: {hits} hits, {misses} misses, {time_saved:.1f}s saved')
+    if failures:
+        print(f'\n{len(failures)} of {len(paper_data)} conversions failed:')
+        for d, returncode, log_path in sorted(failures, key=lambda f: f[0].extra.submission_id):
+            print(f'  {d.extra.submission_id} ({d.extra.original_file}): exit code {returncode}, see {log_path}')
+    return failures
+
+
+def main(csvfile, papersdir, sessions, outputfile, sessionfile, output_dir, year, jobs=None, log_dir=None,
+         cache_path=None, force=False):
     # process .csv of paper data and match it to file locations on disk
     with open(csvfile, encoding=get_csv_encoding(csvfile)) as fp:
         reader = csv.DictReader(fp)
-        for line in reader:
-            paper = process_line(line, year)
-            paper = process_paper(paper, papersdir)
-            paper_data.append(paper)
+        paper_data = [process_line(line, year) for line in reader]
+
+    camera_ready = index_camera_ready(papersdir)
+    problems = check_camera_ready(paper_data, camera_ready)
+    if problems:
+        raise Exception("Can't match all papers to a camera-ready pdf:\n" + "\n".join(problems))
+    paper_data = [process_paper(paper, camera_ready) for paper in paper_data]
 
+    page_counts = count_pages([d.extra.original_file for d in paper_data], jobs)
+    for d, num_pages in zip(paper_data, page_counts):
+        d.extra.num_pages = num_pages
 
     # Export processed metadata to json file
-    with open(outputfile, "w", encoding='utf-8') as fp:
-        json.dump(paper_data, fp, indent=4, ensure_ascii=False)
+    dump_papers(paper_data, outputfile)
 
     # Generate and export session file
     session_list = []
     with open(sessions) as fp:
-        session_list = [line.strip() for line in fp.readlines()]
+        session_list = [line.strip() for line in fp.readlines() if line.strip()]
 
     session_data = generate_session_dict(paper_data, session_list)
 
     with open(sessionfile, "w", encoding='utf-8') as fp:
         json.dump(session_data, fp, indent=4, ensure_ascii=False)
 
-    # copy all papers to new directory
-    output_dir.mkdir(parents=True, exist_ok=True)
-    for d in paper_data:
-        # flush to ensure paper title appears directly above gs output when redirecting
-        # script output to log file
-        print(f'{d["extra"]["submission_id"]} - {d["title"]}', flush=True)
-        subprocess.run([
-            'gs', '-dNOPAUSE', '-dBATCH', '-sDEVICE=pdfwrite',
-            '-dPDFSETTINGS=/prepress', '-dEmbedAllFonts=true',
-            f'-sOutputFile={output_dir / d["extra"]["file"]}',
-            '-f', d["extra"]["original_file"]
-        ])
+    # copy all papers to new directory, embedding all fonts, unless unchanged since the previous run
+    return convert_papers(paper_data, output_dir, log_dir or output_dir / 'gs_logs', jobs or os.cpu_count(),
+                          cache_path or output_dir.with_name(f'{output_dir.name}-gs-cache.json'), force)
 
 
 if __name__ == '__main__':
@@ -171,10 +273,17 @@ if __name__ == '__main__':
     parser.add_argument("csv", help="path to csv file from Microsoft CMT paper platform")
     parser.add_argument("papers", help="directory containing papers downloaded from Microsoft CMT", type=Path)
     parser.add_argument("sessions", help="file with sessions listed in the order we add papers to proceedings")
-    parser.add_argument("-o", "--metadata_path", help="output filename to write metadata json to")
+    parser.add_argument("-o", "--metadata_path", help="output filename to write metadata json to, in JSON Lines format if it ends with .jsonl")
     parser.add_argument("-s", "--sessions_path", help="output filename to write session json to")
     parser.add_argument("-d", "--output_dir", help="directory to write pdfs to", type=Path)
     parser.add_argument("--year", help="the year in which the conference takes place", type=int, default=datetime.date.today().year)
+    parser.add_argument("-j", "--jobs", help="number of parallel Ghostscript conversions (default: number of CPUs)", type=int)
+    parser.add_argument("--log_dir", help="directory to write the Ghostscript log of each paper to (default: OUTPUT_DIR/gs_logs)", type=Path)
+    parser.add_argument("--cache_path", help="manifest of previous Ghostscript conversions (default: OUTPUT_DIR-gs-cache.json next to OUTPUT_DIR)", type=Path)
+    parser.add_argument("--force", help="convert all papers, even if unchanged since the previous run", action="store_true")
 
     args = parser.parse_args()
-    main(args.csv, args.papers, args.sessions, args.metadata_path, args.sessions_path, args.output_dir, args.year)
+    failures = main(args.csv, args.papers, args.sessions, args.metadata_path, args.sessions_path, args.output_dir, args.year,
+                    args.jobs, args.log_dir, args.cache_path, args.force)
+    if failures:
+        sys.exit(1)
@@ -5,6 +5,8 @@ import codecs
 
 import jinja2
 
+from paper_metadata import load_papers, papers_by_id
+
 # We make a custom jinja environment with different keyword strings so that we can write
 # mostly normal tex in the template
 latex_jinja_env = jinja2.Environment(
@@ -29,12 +31,12 @@ def latex_escape(string):
 def build_section(section, order, papers):
     paper_list = []
     for p in section["papers"]:
-        p = str(p)
         paper = papers[p]
         paper_list.append({
-            "title": latex_escape(paper["title"]),
-            "authors": ", ".join(paper["author"]),
-            "file": "articles/{}".format(paper["extra"]["file"])
+            "title": latex_escape(paper.title),
+            "authors": ", ".join(paper.author),
+            "file": "articles/{}".format(paper.extra.file),
+            "num_pages": paper.extra.num_pages,
         })
 
     return {
@@ -45,11 +47,7 @@ def build_section(section, order, papers):
 
 
 def main(jsonfile, orderfile, outputfile):
-    with open(jsonfile) as fp:
-        data = json.load(fp)
-        papers = {}
-        for d in data:
-            papers[str(d["extra"]["submission_id"])] = d
+    papers = papers_by_id(load_papers(jsonfile))
 
     with open(orderfile) as fp:
         paper_order = json.load(fp)
@@ -1,75 +1,289 @@
 #!/usr/bin/python
 import argparse
 import datetime
+import gc
+import hashlib
+import io
 import json
+import mmap
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
 import pypdf
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
 
+from page_map import compute_page_map, check_page_map, check_session_order, load_page_map, paper_entries, report_problems
+from paper_metadata import load_papers, papers_by_id, dump_papers, is_jsonl, PaperLog
 
-def main(proceedings_path, start_page, metadata, session_order_name, output_folder, output_json, final_name):
-    # open proceedings
-    proceedings_pdf = pypdf.PdfReader(open(proceedings_path, 'rb'))
 
-    with open(session_order_name) as fp:
-        session_order = json.load(fp)
+# page hashes of every split file, and the split files written by the last run; written next to the
+# output folder, e.g. split_articles.manifest.json, as the folder itself is published as it is
+MANIFEST = '.manifest.json'
+CHANGED_FILES = '.changed.json'
+# default number of worker processes with --low_memory, as each of them holds its own reader
+LOW_MEMORY_JOBS = 2
 
-    with open(metadata) as fp:
-        paper_data = json.load(fp)
-        all_papers = {}
-        for d in paper_data:
-            all_papers[str(d["extra"]["submission_id"])] = d
+# the proceedings opened by each worker process of the pool
+_proceedings_pdf = None
+_proceedings_map = None
+_page_indices = None
+
+
+def _open_proceedings(proceedings_path, low_memory=False):
+    global _proceedings_pdf, _proceedings_map, _page_indices
+    fp = open(proceedings_path, 'rb')
+    if low_memory:
+        # the operating system reads in the parts of the file that objects are resolved from, and can
+        # drop them again, instead of the reader buffering them
+        with fp:
+            fp = _proceedings_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    _proceedings_pdf = pypdf.PdfReader(fp)
+    _page_indices = {page.indirect_reference.idnum: i for i, page in enumerate(_proceedings_pdf.pages)}
+
+
+def _close_proceedings():
+    global _proceedings_pdf, _proceedings_map, _page_indices
+    _proceedings_pdf.stream.close()
+    _proceedings_pdf = _proceedings_map = _page_indices = None
+
+
+def _release_objects():
+    if _proceedings_map is not None:
+        # release the fonts, images and content streams resolved for this paper, the next paper
+        # resolves what it needs again (the page objects themselves are small and stay cached)
+        _proceedings_pdf.resolved_objects.clear()
+        gc.collect()
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            # also drop the pages of the file read for this paper from the resident set
+            _proceedings_map.madvise(mmap.MADV_DONTNEED)
+
+
+def _object_hash(obj, first_index, hashes):
+    '''Hash of a PDF object and everything it refers to, except the page tree. References to pages
+       are hashed as their position relative to the first page of the paper, so that the hashes do
+       not change when a paper moves in the proceedings. hashes caches the hash of indirect objects.'''
+    if isinstance(obj, IndirectObject):
+        if obj.idnum in _page_indices:
+            return f'page {_page_indices[obj.idnum] - first_index}'.encode()
+        if obj.idnum not in hashes:
+            # an object referring back to itself, e.g. through an annotation
+            hashes[obj.idnum] = b'cycle'
+            hashes[obj.idnum] = _object_hash(obj.get_object(), first_index, hashes)
+        return hashes[obj.idnum]
+    digest = hashlib.sha256(type(obj).__name__.encode())
+    if isinstance(obj, DictionaryObject):
+        for key in sorted(obj):
+            if key != '/Parent':
+                digest.update(key.encode())
+                digest.update(_object_hash(obj.raw_get(key), first_index, hashes))
+        if isinstance(obj, StreamObject):
+            digest.update(obj.get_data())
+    elif isinstance(obj, ArrayObject):
+        for item in obj:
+            digest.update(_object_hash(item, first_index, hashes))
+    else:
+        digest.update(repr(obj).encode())
+    return digest.digest()
+
+
+def page_hashes(first_page, last_page):
+    '''Hashes of the content of the given pages of the proceedings, including their fonts, images and
+       annotations: they only change if the pages look different.'''
+    hashes = {}
+    result = [_object_hash(_proceedings_pdf.pages[p], first_page - 1, hashes).hex()
+              for p in range(first_page - 1, last_page)]
+    _release_objects()
+    return result
+
+
+def optimize(output):
+    '''Compress the page content streams and merge identical objects, e.g. the fonts of the page
+       headers and footers or resources that several pages of a paper include separately. Only the
+       duplicates that merging leaves unreferenced are dropped: resources that a page lists but does
+       not use are kept.'''
+    for page in output.pages:
+        page.compress_content_streams()
+    output.compress_identical_objects()
 
-    os.makedirs(output_folder, exist_ok=True)
 
-    paper_count = 1
-    out_papers = []
+def split_paper(out_path, first_page, last_page, optimized=False):
+    '''Write the given pages of the proceedings to out_path. With optimized, the file is written
+       optimized unless that makes it larger, and the size of the plain and the written file is returned.'''
+    output = pypdf.PdfWriter()
+    for p in range(first_page - 1, last_page):
+        output.add_page(_proceedings_pdf.pages[p])
 
-    for session in session_order:
-        session_name = session["name"]
+    sizes = None
+    if optimized:
+        # both versions are serialized in memory, and only the smaller one is written
+        plain = io.BytesIO()
+        output.write(plain)
+        optimize(output)
+        smaller = io.BytesIO()
+        output.write(smaller)
+        if smaller.tell() >= plain.tell():
+            smaller = plain
+        with open(out_path, 'wb') as f:
+            f.write(smaller.getbuffer())
+        sizes = plain.tell(), smaller.tell()
+    else:
+        with open(out_path, 'wb') as f:
+            output.write(f)
 
-        print("Session name: {}, Starting Page: {}".format(session_name, start_page))
+    del output
+    _release_objects()
+    return sizes
 
-        # skip the session title page and the blank page after it
-        current_paper_start = start_page + 2
 
-        for paper_id in session["papers"]:
-            curr_paper = all_papers[str(paper_id)]
-            current_paper_length = curr_paper["extra"]["num_pages"]
+def unchanged(previous, entry):
+    '''Whether a split file recorded in the manifest has the same pages, regardless of where they are in
+       the proceedings.'''
+    return previous is not None and all(previous.get(key) == entry[key] for key in ("submission_id", "optimized", "pages"))
+
+
+def write_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=4)
+    os.replace(tmp_path, path)
+
+
+def peak_memory(children=False):
+    '''Peak memory in bytes of this process, or of the largest of its worker processes with children.
+       None where it is not available (Windows).'''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def page_ranges(page_map, all_papers):
+    '''The output file name and the first and last page in the proceedings (1-based) of every paper,
+       in the order of the proceedings.'''
+    ranges = []
+    for paper_count, entry in enumerate(paper_entries(page_map), 1):
+        curr_paper = all_papers[entry["submission_id"]]
+        out_filename = "{:0>3}.pdf".format(paper_count)
+        curr_paper.extra.split_file = out_filename
+        ranges.append((curr_paper, out_filename, entry["first_page"], entry["last_page"]))
+    return ranges
+
+
+def main(proceedings_path, start_page, metadata, session_order_name, output_folder, output_json, final_name, jobs=None, low_memory=False, optimized=False, page_map_name=None):
+    with open(session_order_name) as fp:
+        session_order = json.load(fp)
+
+    all_papers = papers_by_id(load_papers(metadata))
+
+    if page_map_name:
+        page_map = load_page_map(page_map_name)
+        check_session_order(page_map, session_order)
+    else:
+        page_map = compute_page_map(session_order, all_papers, start_page)
+    # catch a wrong start page or page count before splitting anything; the proceedings are read the
+    # way the workers read them, and closed before the workers start
+    _open_proceedings(proceedings_path, low_memory)
+    try:
+        report_problems(*check_page_map(page_map, _proceedings_pdf, all_papers))
+    finally:
+        _close_proceedings()
+    for session in page_map["sessions"]:
+        print("Session name: {}, Starting Page: {}".format(session["name"], session["header_page"]))
+        for entry in session["papers"]:
+            print("  {}: pages {}-{}".format(entry["submission_id"], entry["first_page"], entry["last_page"]))
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    ranges = page_ranges(page_map, all_papers)
 
-            print("  Current paper being processed: " + str(paper_id))
+    manifest_path = os.path.normpath(output_folder) + MANIFEST
+    changed_path = os.path.normpath(output_folder) + CHANGED_FILES
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
 
-            current_paper_end = current_paper_start + current_paper_length - 1
-            print("    Start page: {}".format(current_paper_start))
-            print("    End page: {}".format(current_paper_end))
+    # with a JSON Lines output, every paper is recorded as soon as it is split
+    log = PaperLog(output_json) if is_jsonl(output_json) else None
 
-            output = pypdf.PdfWriter()
-            for p in range(current_paper_start - 1, current_paper_end):
-                # print(p)
-                output.add_page(proceedings_pdf.pages[p])
+    # every worker process opens the proceedings itself and hashes or writes the papers it is given
+    if jobs is None and low_memory:
+        jobs = LOW_MEMORY_JOBS
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_open_proceedings, initargs=(proceedings_path, low_memory)) as pool:
+        futures = {pool.submit(page_hashes, first_page, last_page): out_filename
+                   for curr_paper, out_filename, first_page, last_page in ranges}
+        hashes = {futures[future]: future.result() for future in as_completed(futures)}
 
-            out_filename = "{:0>3}.pdf".format(paper_count)
-            print(f"    Output name {out_filename}")
-            with open(os.path.join(output_folder, out_filename), 'wb') as f:
-                output.write(f)
-            paper_count += 1
+        todo = []
+        entries = {}
+        for curr_paper, out_filename, first_page, last_page in ranges:
+            entry = {"submission_id": curr_paper.extra.submission_id, "first_page": first_page, "last_page": last_page,
+                     "optimized": optimized, "pages": hashes[out_filename]}
+            entries[out_filename] = entry
+            if not os.path.exists(os.path.join(output_folder, out_filename)):
+                todo.append((curr_paper, out_filename, first_page, last_page))
+            elif unchanged(manifest.get(out_filename), entry):
+                print(f"{out_filename} unchanged")
+                # the pages may have moved in the proceedings
+                manifest[out_filename] = entry
+            else:
+                todo.append((curr_paper, out_filename, first_page, last_page))
+        # split files of papers no longer in the proceedings
+        removed = sorted(set(manifest) - set(entries))
+        for out_filename in removed:
+            del manifest[out_filename]
 
-            current_paper_start = current_paper_end + 1
-            curr_paper["extra"]["split_file"] = out_filename
-            out_papers.append(curr_paper)
+        futures = {pool.submit(split_paper, os.path.join(output_folder, out_filename), first_page, last_page, optimized): (curr_paper, out_filename)
+                   for curr_paper, out_filename, first_page, last_page in todo}
+        total_before = total_after = 0
+        for future in as_completed(futures):
+            curr_paper, out_filename = futures[future]
+            sizes = future.result()
+            if sizes:
+                before, after = sizes
+                total_before += before
+                total_after += after
+                if after < before:
+                    print(f"Written {out_filename}: {before} -> {after} bytes ({(after - before) / before:+.0%})")
+                else:
+                    print(f"Written {out_filename}: {before} bytes, not optimized as that made it larger")
+            else:
+                print(f"Written {out_filename}")
+            if log:
+                log.append(curr_paper)
+            # recorded as soon as it is written, so that an interrupted run does not write it again
+            manifest[out_filename] = entries[out_filename]
+            write_manifest(manifest_path, manifest)
+    write_manifest(manifest_path, manifest)
 
-        # The session title page is always on the right-hand side of the book (odd page number)
-        # so if the last page of the last paper was odd, a blank page is inserted before the header
-        # we already added 1 onto the start, so if even we add another one
-        if current_paper_start % 2 == 0:
-            print("Adding blank page between sections")
-            start_page = current_paper_start + 1
-        else:
-            start_page = current_paper_start
+    written = {out_filename for _, out_filename, *_ in todo}
+    changed = {"changed": [{"submission_id": curr_paper.extra.submission_id, "split_file": out_filename}
+                           for curr_paper, out_filename, *_ in ranges if out_filename in written],
+               "removed": removed}
+    with open(changed_path, 'w') as fp:
+        json.dump(changed, fp, indent=4)
+    print(f"{len(written)} of {len(ranges)} split files written, list in {changed_path}")
+    if removed:
+        print(f"WARNING: split files of papers no longer in the proceedings: {', '.join(removed)}")
 
-    with open(output_json, "w", encoding='utf-8') as fp:
-        json.dump(out_papers, fp, indent=4, ensure_ascii=False)
+    if log:
+        log.close()
+    if optimized and total_before:
+        print(f"Optimized split files: {total_before} -> {total_after} bytes ({(total_after - total_before) / total_before:+.0%})")
+    if resource is not None:
+        print(f"Peak memory: {peak_memory() / 2**20:.0f} MB in the main process, "
+              f"{peak_memory(children=True) / 2**20:.0f} MB in the largest worker process")
+    # for JSON Lines, this rewrites the log in session order, with the papers that were not written again
+    dump_papers([curr_paper for curr_paper, *_ in ranges], output_json)
 
     proceedings_path.rename(proceedings_path.parent / final_name)
 
@@ -79,10 +293,19 @@ if __name__ == "__main__":
     parser.add_argument("proceedings", help="The complete proceedings document", type=Path)
     parser.add_argument("metadata", help="JSON containing metadata generated from CSV")
     parser.add_argument("order", help="JSON file describing sections and paper order")
-    parser.add_argument("-s", "--start_page", type=int, required=True, help="The starting page in the pdf file that the first section starts at")
+    parser.add_argument("-s", "--start_page", type=int, help="The starting page in the pdf file that the first section starts at")
+    parser.add_argument("--page_map", help="page map JSON file generated by page_map.py, instead of --start_page")
     parser.add_argument("-o", "--output_dir", required=True, help="output directory to write split files to")
-    parser.add_argument("-j", "--json", required=True, help="output JSON metadata file")
+    parser.add_argument("-j", "--json", required=True, help="output JSON metadata file, in JSON Lines format if it ends with .jsonl")
+    parser.add_argument("--jobs", type=int, help=f"number of worker processes splitting papers concurrently (default: number of CPUs, {LOW_MEMORY_JOBS} with --low_memory)")
+    parser.add_argument("--low_memory", action="store_true", help="memory-map the proceedings and release the objects read for each paper once it is written")
+    parser.add_argument("--optimize", action="store_true", help="compress content streams and merge identical objects in the split files (unused page resources are kept), unless that makes them larger, reporting the sizes before and after")
     parser.add_argument("--final_name", help="name of the final PDF proceedings", default=f"{datetime.date.today().year}_Proceedings_ISMIR.pdf")
 
     args = parser.parse_args()
-    main(args.proceedings, args.start_page, args.metadata, args.order, args.output_dir, args.json, args.final_name)
+    if (args.start_page is None) == (args.page_map is None):
+        parser.error("exactly one of --start_page and --page_map is required")
+    try:
+        main(args.proceedings, args.start_page, args.metadata, args.order, args.output_dir, args.json, args.final_name, args.jobs, args.low_memory, args.optimize, args.page_map)
+    except ValueError as e:
+        sys.exit(str(e))
@@ -1,79 +1,51 @@
 #!/usr/bin/python
 import argparse
 import json
-import jinja2
 import os
-import copy
+import sys
 
+from exporters import EMITTERS, DEFAULT_BOOKTITLE
+from page_map import compute_page_map, check_session_order, load_page_map
+from paper_metadata import load_papers, papers_by_id
 
-def main(paperlist_name, session_order_name, start_page, output_dir):
+
+def main(paperlist_name, session_order_name, start_page, output_dir, page_map_name=None, formats=tuple(EMITTERS), booktitle=DEFAULT_BOOKTITLE):
 
     with open(session_order_name, encoding='utf-8') as fp:
         session_order = json.load(fp)
 
-    with open(paperlist_name, encoding='utf-8') as fp:
-        data = json.load(fp)
-        papers = {}
-        for d in data:
-            papers[str(d["extra"]["submission_id"])] = d
+    papers = papers_by_id(load_papers(paperlist_name))
+
+    if page_map_name:
+        page_map = load_page_map(page_map_name)
+        check_session_order(page_map, session_order)
+        if start_page is not None:
+            page_map = compute_page_map(session_order, papers, page_map["start_page"], start_page)
+        elif page_map["printed_start_page"] is None:
+            raise ValueError("The page map has no printed page numbers, pass --start_page")
+    else:
+        page_map = compute_page_map(session_order, papers, printed_start_page=start_page)
 
     os.makedirs(output_dir, exist_ok=True)
 
-    sessions = []
-    internal_json = []
-    publications = []
-    for session in session_order:
+    emitters = [EMITTERS[name](output_dir, booktitle) for name in formats]
+    for emitter in emitters:
+        emitter.begin()
+    # every paper is visited once and handed to all output formats
+    for session in page_map["sessions"]:
         session_name = session["name"]
 
-        # print("Session name: {}, Starting Page: {}".format(session_name, start_page))
-
-        # skip the session title page and the blank page after it
-        current_paper_start = start_page + 2
-
-        for paper_id in session["papers"]:
-            paper = papers[str(paper_id)]
-            current_paper_length = paper["extra"]["num_pages"]
-            current_paper_end = current_paper_start + current_paper_length - 1
-            paper["pages"] = "{}-{}".format(current_paper_start, current_paper_end)
-
-            url = "https://archives.ismir.net/ismir{}/paper/{}".format(paper["year"], paper["extra"]["split_file"])
-            paper["ee"] = url
-            internal_json.append(paper)
-            paper_publication = copy.deepcopy(paper)
-            paper_publication.pop("extra")
-            publications.append(paper_publication)
-            current_paper_start = current_paper_end + 1
-
-        sessions.append({'title': session_name,
-                         'publications': internal_json})
-
-        # The session title page is always on the right-hand side of the book (odd page number)
-        # so if the last page of the last paper was odd, a blank page is inserted before the header
-        # we already added 1 onto the start, so if even we add another one
-        if current_paper_start % 2 == 0:
-            print("Adding blank page between sections")
-            start_page = current_paper_start + 1
-        else:
-            start_page = current_paper_start
-
-    context = {
-            'sessions': sessions
-        }
-
-    # get jinja template
-    PATH = os.path.dirname(os.path.abspath(__file__))
-    template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(PATH, 'templates')))
-
-    template = template_env.get_template('overview.csv')
-    with open(os.path.join(output_dir, 'overview.csv'), 'w') as f:
-        csv = template.render(context)
-        f.write(csv)
-
-    with open(os.path.join(output_dir, '202x.json'), 'w', encoding='utf-8') as fp:
-        json.dump(publications, fp, indent=4, ensure_ascii=False)
+        for entry in session["papers"]:
+            paper = papers[entry["submission_id"]]
+            paper.pages = "{}-{}".format(entry["printed_first_page"], entry["printed_last_page"])
 
-    with open(os.path.join(output_dir, '202x_internal.json'), 'w', encoding='utf-8') as fp:
-        json.dump(internal_json, fp, indent=4, ensure_ascii=False)
+            url = "https://archives.ismir.net/ismir{}/paper/{}".format(paper.year, paper.extra.split_file)
+            paper.ee = url
+            for emitter in emitters:
+                emitter.paper(paper, session_name)
+    for emitter in emitters:
+        emitter.end()
+        print(f"Written {emitter.path}")
 
 
 if __name__ == '__main__':
@@ -81,7 +53,15 @@ if __name__ == '__main__':
     parser.add_argument("paperlist", help="JSON containing metadata generated during proceedings split during Step-4, with updated PDF paths")
     parser.add_argument("order", help="JSON file describing sections and paper order")
     parser.add_argument("-o", required=True, help="output directory to write split files to")
-    parser.add_argument("--start_page", type=int, required=True, help="page that Section A starts in proceedings (page number from page footer, not pdf number)")
+    parser.add_argument("--start_page", type=int, help="page that Section A starts in proceedings (page number from page footer, not pdf number)")
+    parser.add_argument("--page_map", help="page map JSON file generated by page_map.py, with the printed page numbers of the papers")
+    parser.add_argument("--formats", nargs='+', choices=EMITTERS, default=list(EMITTERS), help="output formats to write (default: all)")
+    parser.add_argument("--booktitle", default=DEFAULT_BOOKTITLE, help="title of the proceedings for the BibTeX and CSL-JSON entries, e.g. the \\proctitle of the proceedings")
 
     args = parser.parse_args()
-    main(args.paperlist, args.order, args.start_page, args.o)
+    if args.start_page is None and args.page_map is None:
+        parser.error("--start_page or --page_map is required")
+    try:
+        main(args.paperlist, args.order, args.start_page, args.o, args.page_map, args.formats, args.booktitle)
+    except ValueError as e:
+        sys.exit(str(e))
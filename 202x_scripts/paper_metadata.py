@@ -0,0 +1,108 @@
+import json
+from dataclasses import dataclass, field, fields
+
+
+@dataclass(slots=True)
+class Extra:
+    '''Metadata for internal use only, dropped from the public archive JSON.'''
+    email: dict = field(default_factory=dict)
+    affiliation: dict = field(default_factory=dict)
+    takeaway: str = None
+    external_links: str = None
+    submission_id: int = None
+    session_id: str = None
+    session_position: int = None
+    subject_area_primary: str = None
+    subject_area_secondary: list = field(default_factory=list)
+    num_pages: int = None
+    file: str = None
+    split_file: str = None
+    original_file: str = None
+
+
+@dataclass(slots=True)
+class Paper:
+    '''A paper record in the format of the proceedings archive, with the internal metadata in `extra`.'''
+    title: str = None
+    author: list = field(default_factory=list)
+    year: str = None
+    doi: str = None
+    url: str = None
+    pages: str = None
+    abstract: str = None
+    zenodo_id: int = None
+    dblp_key: str = None
+    ee: str = None
+    extra: Extra = field(default_factory=Extra)
+
+    @classmethod
+    def from_json(cls, record):
+        record = dict(record)
+        extra = record.pop("extra", {})
+        return cls(**record, extra=Extra(**extra))
+
+    def to_public_json(self):
+        return {name: getattr(self, name) for name in PUBLIC_FIELDS}
+
+    def to_internal_json(self):
+        record = self.to_public_json()
+        record["extra"] = {name: getattr(self.extra, name) for name in EXTRA_FIELDS}
+        return record
+
+
+PUBLIC_FIELDS = tuple(f.name for f in fields(Paper) if f.name != "extra")
+EXTRA_FIELDS = tuple(f.name for f in fields(Extra))
+
+
+def is_jsonl(path):
+    return str(path).endswith('.jsonl')
+
+
+def load_papers(path):
+    '''Read paper records from a JSON file, or from a JSON Lines file in which later records replace
+       earlier ones with the same submission id.'''
+    with open(path, encoding='utf-8') as fp:
+        if not is_jsonl(path):
+            return [Paper.from_json(record) for record in json.load(fp)]
+        papers = {}
+        for line in fp:
+            if not line.endswith('\n'):
+                # incomplete last record of an interrupted run
+                break
+            paper = Paper.from_json(json.loads(line))
+            papers[paper.extra.submission_id] = paper
+        return list(papers.values())
+
+
+def papers_by_id(papers):
+    return {paper.extra.submission_id: paper for paper in papers}
+
+
+def dump_papers(papers, path, public=False):
+    records = [paper.to_public_json() if public else paper.to_internal_json() for paper in papers]
+    with open(path, "w", encoding='utf-8') as fp:
+        if is_jsonl(path):
+            fp.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        else:
+            json.dump(records, fp, indent=4, ensure_ascii=False)
+
+
+class PaperLog:
+    '''JSON Lines file to which paper records are appended as soon as they are completed, so that the
+       progress of a long step can be followed and the records of an interrupted run are not lost.'''
+
+    def __init__(self, path):
+        self.fp = open(path, 'w', encoding='utf-8')
+
+    def append(self, paper):
+        self.fp.write(json.dumps(paper.to_internal_json(), ensure_ascii=False) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
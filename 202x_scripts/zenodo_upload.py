@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+'''Upload the papers of the final JSON (Step-6) to Zenodo, several at a time, and write the JSON with
+their DOIs and Zenodo records. Every step of every paper is appended to a journal as soon as it is done,
+so that an interrupted upload can be restarted with the same command: finished papers are skipped and
+unfinished ones continue with the deposition they already have, without listing the depositions.'''
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from exporters import name_parts
+from paper_metadata import dump_papers, load_papers
+
+
+API_URLS = {
+    'prod': 'https://zenodo.org/api',
+    'dev': 'https://sandbox.zenodo.org/api',
+}
+TOKEN_VARIABLES = {
+    'prod': 'ZENODO_TOKEN_PROD',
+    'dev': 'ZENODO_TOKEN_DEV',
+}
+# responses after which a request is sent again: rate limiting and server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+TIMEOUT = 300
+# metadata of every paper, unless set by the conference metadata
+DEFAULT_METADATA = {
+    'upload_type': 'publication',
+    'publication_type': 'conferencepaper',
+    'access_right': 'open',
+}
+
+
+class ZenodoError(RuntimeError):
+    pass
+
+
+class ZenodoClient:
+    '''The deposition API of Zenodo over one HTTP session, whose connection pool is shared by all threads.
+       Failed requests are retried with exponential backoff: those that were rate limited, and those
+       that failed with a server or connection error if sending them again is harmless.'''
+
+    def __init__(self, api_url, token, pool_size=10, retries=5, backoff=1.0):
+        self.api_url = api_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {token}'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, expected=(200,), upload_path=None, **kwargs):
+        '''Send a request to url (relative to the API URL unless absolute) and return the decoded JSON
+           response. upload_path is a file to send as the request body, opened again for every attempt.'''
+        if not url.startswith(('http://', 'https://')):
+            url = self.api_url + url
+        # a POST that failed on the server may have had an effect, e.g. created a deposition
+        idempotent = method != 'POST'
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                if upload_path:
+                    with open(upload_path, 'rb') as fp:
+                        response = self.session.request(method, url, data=fp, timeout=TIMEOUT, **kwargs)
+                else:
+                    response = self.session.request(method, url, timeout=TIMEOUT, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt == self.retries:
+                    raise ZenodoError(f'{method} {url}: {e}') from e
+            else:
+                if response.status_code in expected:
+                    return response.json() if response.content else None
+                retry = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS)
+                if not retry or attempt == self.retries:
+                    raise ZenodoError(f'{method} {url}: {response.status_code} {response.text[:500]}')
+                if response.headers.get('Retry-After', '').isdigit():
+                    delay = int(response.headers['Retry-After'])
+            time.sleep(delay)
+
+    def deposition_page(self, page, size):
+        return self.request('GET', '/deposit/depositions', params={'page': page, 'size': size, 'sort': 'mostrecent'})
+
+    def list_depositions(self, jobs=4, page_size=100):
+        '''All depositions of the account. The pages are fetched jobs at a time, until one of them is not full.'''
+        depositions = {}
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            first = 1
+            while True:
+                pages = list(pool.map(self.deposition_page, range(first, first + jobs), [page_size] * jobs))
+                # a deposition created while listing moves the others to later pages
+                depositions.update((deposition['id'], deposition) for page in pages for deposition in page)
+                if any(len(page) < page_size for page in pages):
+                    return list(depositions.values())
+                first += jobs
+
+    def get_deposition(self, deposition_id):
+        return self.request('GET', f'/deposit/depositions/{deposition_id}')
+
+    def create_deposition(self):
+        return self.request('POST', '/deposit/depositions', expected=(201,), json={})
+
+    def upload_file(self, deposition, path):
+        '''Upload path to the bucket of the deposition, replacing a file of the same name.'''
+        return self.request('PUT', f'{deposition["links"]["bucket"]}/{Path(path).name}', expected=(200, 201),
+                            upload_path=path, headers={'Content-Type': 'application/octet-stream'})
+
+    def update_metadata(self, deposition_id, metadata):
+        return self.request('PUT', f'/deposit/depositions/{deposition_id}', json={'metadata': metadata})
+
+    def publish(self, deposition_id):
+        return self.request('POST', f'/deposit/depositions/{deposition_id}/actions/publish', expected=(202,))
+
+    def edit(self, deposition_id):
+        '''Unlock the metadata of a published deposition for editing.'''
+        return self.request('POST', f'/deposit/depositions/{deposition_id}/actions/edit', expected=(201,))
+
+    def new_version(self, deposition_id):
+        '''Create a draft of a new version of a published deposition, with a copy of its files.'''
+        deposition = self.request('POST', f'/deposit/depositions/{deposition_id}/actions/newversion', expected=(201,))
+        return self.request('GET', deposition['links']['latest_draft'])
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadJournal:
+    '''JSON Lines file to which a record is appended for every step of an upload that is done. The
+       state of a paper, keyed by the name of its file, is its records of the same API merged in order.'''
+
+    def __init__(self, path, api_url):
+        self.api_url = api_url
+        self.state = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'rb+') as fp:
+                # drop an incomplete last record
+                data = fp.read()
+                fp.truncate(data.rfind(b'\n') + 1)
+            for line in data[:data.rfind(b'\n') + 1].decode('utf-8').splitlines():
+                record = json.loads(line)
+                if record.pop('api') == api_url:
+                    self.state.setdefault(record['file'], {}).update(record)
+        self.fp = open(path, 'a', encoding='utf-8')
+
+    def append(self, file, **record):
+        '''Record a step of the upload of file and return its new state.'''
+        record = {'file': file, 'api': self.api_url, **record, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with self.lock:
+            self.fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.fp.flush()
+            del record['api']
+            state = self.state.setdefault(file, {})
+            state.update(record)
+            return dict(state)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DepositionIndex:
+    '''Depositions by the names and by the MD5 checksums of their files.'''
+
+    def __init__(self, depositions):
+        self.by_file = {}
+        self.by_checksum = {}
+        for deposition in depositions:
+            for file in deposition.get('files', []):
+                self.by_file.setdefault(file['filename'], []).append(deposition)
+                self.by_checksum.setdefault(file['checksum'], []).append(deposition)
+
+    def find(self, file, md5=None):
+        '''The depositions of a file, those with the same content first if md5 is given.'''
+        candidates = self.by_checksum.get(md5, []) if md5 else []
+        ids = {deposition['id'] for deposition in candidates}
+        return candidates + [deposition for deposition in self.by_file.get(file, []) if deposition['id'] not in ids]
+
+
+def paper_file(paper):
+    '''Name of the split file of a paper, the last part of its archive URL.'''
+    return paper.ee.split('/')[-1]
+
+
+def creator_name(name):
+    '''An author name as Zenodo expects it, "Family, Given".'''
+    first, von, last, _ = name_parts(name)
+    family = ' '.join(part for part in (von, last) if part)
+    return f'{family}, {first}' if first else family
+
+
+def zenodo_metadata(paper, conference):
+    metadata = dict(DEFAULT_METADATA, **conference)
+    metadata.update({
+        'title': paper.title,
+        'creators': [{'name': creator_name(name)} for name in paper.author],
+        'description': paper.abstract or paper.title,
+    })
+    if paper.pages:
+        metadata['partof_pages'] = paper.pages
+    return metadata
+
+
+def metadata_hash(metadata):
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def plain_text(value):
+    '''Text of an HTML metadata field without tags, entities and repeated whitespace. Zenodo sanitizes the
+       HTML of the description, escaping characters and wrapping plain text in a paragraph.'''
+    text = re.sub(r'</?[A-Za-z][^<>]*>', ' ', value or '')
+    return ' '.join(html.unescape(text).split())
+
+
+def remote_changes(deposition, md5, metadata):
+    '''Whether the file and the metadata of a deposition differ from the local ones. Zenodo adds to and
+       normalizes the metadata, so only the fields that come from the paper are compared, as plain text.'''
+    file_changed = md5 not in {file['checksum'] for file in deposition.get('files', [])}
+    remote = deposition['metadata']
+    metadata_changed = (any(plain_text(remote.get(name)) != plain_text(metadata.get(name)) for name in ('title', 'description'))
+                        or remote.get('partof_pages') != metadata.get('partof_pages')
+                        or [creator['name'] for creator in remote.get('creators', [])]
+                        != [creator['name'] for creator in metadata['creators']])
+    return file_changed, metadata_changed
+
+
+def upload_paper(client, journal, paper, pdf_path, metadata, check_remote=False):
+    '''Upload a paper, continuing from its state in the journal. A published paper is skipped if neither
+       its file nor its metadata changed since, as recorded in the journal or, with check_remote, on
+       Zenodo. If only the metadata changed, it is updated; if the file changed, a new version is
+       published. Returns the state of the paper and what was done.'''
+    file = paper_file(paper)
+    state = journal.state.get(file, {})
+    md5 = file_md5(pdf_path)
+    digest = metadata_hash(metadata)
+    action = 'uploaded'
+    if state.get('step') in ('uploaded', 'editing'):
+        # the previous run may have been interrupted after publishing, before recording it
+        deposition = client.get_deposition(state['deposition_id'])
+        if deposition['state'] == 'done':
+            _, metadata_changed = remote_changes(deposition, md5, metadata)
+            state = journal.append(file, step='published', doi=deposition['doi'], record_id=deposition['record_id'],
+                                   metadata_hash=None if metadata_changed else digest)
+    if state.get('step') == 'published':
+        file_changed, metadata_changed = state['md5'] != md5, state.get('metadata_hash') != digest
+        if check_remote:
+            remote_file, remote_metadata = remote_changes(client.get_deposition(state['deposition_id']), md5, metadata)
+            file_changed, metadata_changed = file_changed or remote_file, metadata_changed or remote_metadata
+        if file_changed:
+            # the files of a published record cannot be changed
+            draft = client.new_version(state['deposition_id'])
+            state = journal.append(file, step='created', deposition_id=draft['id'],
+                                   doi=draft['metadata']['prereserve_doi']['doi'], bucket=draft['links']['bucket'])
+            action = 'new version'
+        elif metadata_changed:
+            client.edit(state['deposition_id'])
+            state = journal.append(file, step='editing')
+            action = 'metadata updated'
+        else:
+            return state, 'skipped'
+
+    if 'deposition_id' not in state:
+        deposition = client.create_deposition()
+        state = journal.append(file, step='created', deposition_id=deposition['id'],
+                               doi=deposition['metadata']['prereserve_doi']['doi'], bucket=deposition['links']['bucket'])
+    if state['step'] != 'editing' and (state['step'] == 'created' or state.get('md5') != md5):
+        uploaded = client.upload_file({'links': {'bucket': state['bucket']}}, pdf_path)
+        if uploaded.get('checksum') != f'md5:{md5}':
+            raise ZenodoError(f'{file}: checksum of the uploaded file is {uploaded.get("checksum")} instead of md5:{md5}')
+        state = journal.append(file, step='uploaded', md5=md5)
+
+    client.update_metadata(state['deposition_id'], metadata)
+    record = client.publish(state['deposition_id'])
+    state = journal.append(file, step='published', doi=record['doi'], record_id=record['record_id'], metadata_hash=digest)
+    return state, action
+
+
+def record_url(api_url, state, file):
+    return f'{api_url.rstrip("/").removesuffix("/api")}/records/{state["record_id"]}/files/{file}'
+
+
+def main(input_json, pdf_dir, output_json, conference_json=None, stage='dev', api_url=None,
+         journal_path=None, jobs=4, retries=5, check_remote=False, backoff=1.0):
+    token = os.environ.get(TOKEN_VARIABLES[stage])
+    if not token:
+        raise ZenodoError(f'{TOKEN_VARIABLES[stage]} is not set')
+    api_url = api_url or API_URLS[stage]
+    journal_path = journal_path or Path(output_json).with_suffix('.journal.jsonl')
+
+    papers = load_papers(input_json)
+    conference = {}
+    if conference_json:
+        with open(conference_json, encoding='utf-8') as fp:
+            conference = json.load(fp)
+        # the conferences.json of conference-archive, keyed by year
+        years = {paper.year for paper in papers}
+        if len(years) == 1 and isinstance(conference.get(next(iter(years))), dict):
+            conference = conference[years.pop()]
+
+    missing = [paper_file(paper) for paper in papers if not (Path(pdf_dir) / paper_file(paper)).exists()]
+    if missing:
+        raise ZenodoError(f'{len(missing)} split files not found in {pdf_dir}: {", ".join(missing)}')
+
+    client = ZenodoClient(api_url, token, pool_size=jobs, retries=retries, backoff=backoff)
+    failures = []
+    actions = Counter()
+    start = time.perf_counter()
+    with UploadJournal(journal_path, api_url) as journal, ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(upload_paper, client, journal, paper, Path(pdf_dir) / paper_file(paper),
+                               zenodo_metadata(paper, conference), check_remote): paper for paper in papers}
+        for future in as_completed(futures):
+            paper = futures[future]
+            try:
+                state, status = future.result()
+            except ZenodoError as e:
+                failures.append((paper_file(paper), e))
+                status = f'FAILED ({e})'
+            else:
+                actions[status] += 1
+                status = f'{status}, {state["doi"]}'
+            print(f'{paper_file(paper)}: {status}', flush=True)
+
+        for paper in papers:
+            state = journal.state.get(paper_file(paper), {})
+            # the last published version, also if a later update failed
+            if 'record_id' in state:
+                paper.zenodo_id = state['record_id']
+                paper.doi = state['doi']
+                paper.url = f'https://doi.org/{state["doi"]}'
+                paper.ee = record_url(api_url, state, paper_file(paper))
+    dump_papers(papers, output_json, public=True)
+
+    print(f'{len(papers) - len(failures)} of {len(papers)} papers published in {time.perf_counter() - start:.1f}s '
+          f'({", ".join(f"{count} {action}" for action, count in sorted(actions.items()))}), written to {output_json}')
+    if failures:
+        print(f'\n{len(failures)} papers failed, run the same command again to retry them:')
+        for file, error in sorted(failures):
+            print(f'  {file}: {error}')
+    return failures
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Upload the split papers to Zenodo concurrently, resuming an interrupted upload from its journal")
+    parser.add_argument("metadata", help="final JSON of Step-6 (202x.json)")
+    parser.add_argument("pdf_dir", help="directory of the split papers (split_articles)")
+    parser.add_argument("output", help="output JSON, the final JSON with the DOIs and Zenodo URLs")
+    parser.add_argument("-c", "--conference", help="JSON with the Zenodo metadata of the conference, e.g. database/conferences.json of conference-archive")
+    parser.add_argument("--stage", choices=sorted(API_URLS), default='dev', help="Zenodo sandbox (dev) or Zenodo (prod), the token is read from ZENODO_TOKEN_DEV or ZENODO_TOKEN_PROD")
+    parser.add_argument("--api_url", help="URL of the Zenodo API, overriding --stage, e.g. of a local test server")
+    parser.add_argument("--journal", help="journal of the upload (default: the output file with .journal.jsonl)")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="number of papers to upload concurrently")
+    parser.add_argument("--retries", type=int, default=5, help="number of times a failed request is retried")
+    parser.add_argument("--backoff", type=float, default=1.0, help="delay in seconds before the first retry of a request, doubled for every further retry")
+    parser.add_argument("--check_remote", action="store_true", help="compare the files and metadata of published papers with their depositions on Zenodo, not only with the journal")
+
+    args = parser.parse_args()
+    try:
+        if main(args.metadata, args.pdf_dir, args.output, args.conference, args.stage, args.api_url,
+                args.journal, args.jobs, args.retries, args.check_remote, args.backoff):
+            sys.exit(1)
+    except ZenodoError as e:
+        sys.exit(str(e))